@@ -7,20 +7,23 @@ import logging
 import uuid
 from datetime import timedelta
 import jwt
-import aiohttp
 import aiofiles
 
-from quart import Quart, request, jsonify, send_from_directory, websocket
+from quart import Quart, request, jsonify, send_from_directory, websocket, g, make_response
 from quart_cors import cors
 from quart_rate_limiter import RateLimiter, rate_limit
 from common.config.config import MOCK_AI, ENTITY_VERSION, API_PREFIX, API_URL, ENABLE_AUTH, MAX_TEXT_SIZE, \
     MAX_FILE_SIZE, CHAT_REPOSITORY, RAW_REPOSITORY_URL, MAX_GUEST_CHATS, AUTH_SECRET_KEY, \
-    MAX_ITERATION
+    MAX_ITERATION, AUTH_OFFLINE_VERIFICATION, QUESTION_STREAM_POLL_INTERVAL, MAX_DIALOGUE_PAGE_SIZE, METRICS_ENABLED
+from common.auth.principal import resolve_principal
 from common.config.conts import OPEN_AI
-from common.exception.exceptions import ChatNotFoundException, InvalidTokenException
+from common.exception.exceptions import ChatNotFoundException, InvalidTokenException, UnknownSigningKeyException, \
+    ConflictException
 from common.util.file_reader import read_file_content
-from common.util.utils import send_get_request, current_timestamp, clone_repo, \
-    validate_token
+from common.util.http_client import http_client
+from common.util.utils import current_timestamp, clone_repo, custom_serializer
+from entity.chat.dialogue import append_to_flow, truncate_flow, get_dialogue, get_dialogue_page
+from entity.chat.question_broker import peek_questions, take_questions
 from logic.init import BeanFactory
 
 PUSH_NOTIFICATION = "push_notification"
@@ -35,7 +38,20 @@ factory = BeanFactory(config={"CHAT_REPOSITORY": "cyoda"})
 ai_agent = factory.get_services()["ai_agent"]
 entity_service = factory.get_services()["entity_service"]
 flow_processor = factory.get_services()["flow_processor"]
-chat_lock = factory.get_services()["chat_lock"]
+chat_locks = factory.get_services()["chat_locks"]
+question_broker = factory.get_services()["question_broker"]
+token_validation_cache = factory.get_services()["token_validation_cache"]
+jwt_verifier = factory.get_services()["jwt_verifier"]
+entity_repository = factory.get_services()["entity_repository"]
+
+
+def _chat_summary(technical_id, chat):
+    return {
+        'technical_id': technical_id,
+        'name': chat.get('name'),
+        'description': chat.get('description'),
+        'date': chat.get('date'),
+    }
 
 
 async def load_fsm():
@@ -62,6 +78,36 @@ async def add_cors_headers():
         return response
 
 
+@app.before_serving
+async def start_http_client():
+    await http_client.start()
+
+
+@app.after_serving
+async def flush_pending_writes():
+    await entity_service.flush()
+
+
+@app.after_serving
+async def close_repository():
+    await entity_repository.close()
+
+
+@app.after_serving
+async def close_http_client():
+    await http_client.close()
+
+
+@app.before_request
+async def resolve_request_principal():
+    g.principal = resolve_principal(request.headers.get('Authorization'))
+
+
+@app.before_websocket
+async def resolve_websocket_principal():
+    g.principal = resolve_principal(websocket.headers.get('Authorization'))
+
+
 @app.errorhandler(InvalidTokenException)
 async def handle_unauthorized_exception(error):
     return jsonify({"error": str(error)}), 401
@@ -72,6 +118,11 @@ async def handle_chat_not_found_exception(error):
     return jsonify({"error": str(error)}), 404
 
 
+@app.errorhandler(ConflictException)
+async def handle_conflict_exception(error):
+    return jsonify({"error": str(error)}), 409
+
+
 @app.errorhandler(Exception)
 async def handle_any_exception(error):
     logger.exception(error)
@@ -84,19 +135,11 @@ def auth_required(func):
     async def wrapper(*args, **kwargs):
 
         if ENABLE_AUTH:
-            # Check for Authorization header
-            auth_header = websocket.headers.get('Authorization') if websocket else request.headers.get('Authorization')
-            if not auth_header:
-                raise InvalidTokenException("Invalid token")
-
-            user_id = _get_user_id(auth_header=auth_header)
-            if user_id.startswith('guest.'):
+            principal = _get_principal()
+            if principal.is_guest:
                 return jsonify({"error": "This action is not available. Please sign in to proceed"}), 403
 
-            token = auth_header.split(" ")[1]
-            response = await send_get_request(token, API_URL, "v1")
-            # todo
-            if not response or (response.get("status") and response.get("status") == 401):
+            if not await _is_valid_user_token(principal.token):
                 raise InvalidTokenException("Invalid token")
 
         # If the token is valid, proceed to the requested route
@@ -111,15 +154,9 @@ def auth_required_to_proceed(func):
     async def wrapper(*args, **kwargs):
 
         if ENABLE_AUTH:
-            # Check for Authorization header
-            auth_header = websocket.headers.get('Authorization') if websocket else request.headers.get('Authorization')
-            if not auth_header:
-                raise InvalidTokenException("Invalid token")
-
-            user_id = _get_user_id(auth_header=auth_header)
-            if user_id.startswith('guest.'):
-                chat = await _get_chat_for_user(request=request, auth_header=auth_header,
-                                                technical_id=request.view_args.get("technical_id"))
+            principal = _get_principal()
+            if principal.is_guest:
+                chat = await _get_chat_for_user(technical_id=request.view_args.get("technical_id"))
                 current_stack = chat["chat_flow"]["current_flow"]
                 if not current_stack:
                     return jsonify({"error": "Max iteration reached, please sign in to proceed"}), 403
@@ -127,11 +164,7 @@ def auth_required_to_proceed(func):
                 if not next_event.get("allow_anonymous_users", False):
                     return jsonify({"error": "Max iteration reached, please sign in to proceed"}), 403
             else:
-                token = auth_header.split(" ")[1]
-                # Call external service to validate the token
-                response = await send_get_request(token, API_URL, "v1")
-                # todo
-                if not response or (response.get("status") and response.get("status") == 401):
+                if not await _is_valid_user_token(principal.token):
                     raise InvalidTokenException("Invalid token")
 
         # If the token is valid, proceed to the requested route
@@ -140,11 +173,25 @@ def auth_required_to_proceed(func):
     return wrapper
 
 
-def _get_user_token(auth_header):
-    if not auth_header:
-        return None
-    token = auth_header.split(" ")[1]
-    return token
+async def _is_valid_user_token(token):
+    if AUTH_OFFLINE_VERIFICATION:
+        try:
+            await jwt_verifier.verify(token)
+            return True
+        except InvalidTokenException:
+            return False
+        except UnknownSigningKeyException:
+            # Fall back to the remote check for tokens signed with a key we don't know
+            pass
+    # Call external service to validate the token (cached per token)
+    return await token_validation_cache.is_valid(token)
+
+
+def _get_principal():
+    principal = g.get("principal")
+    if not principal:
+        raise InvalidTokenException()
+    return principal
 
 
 @app.route('/')
@@ -163,42 +210,67 @@ async def get_chat_flow():
 @app.route(API_PREFIX + '/chats', methods=['GET'])
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def get_chats():
-    auth_header = request.headers.get('Authorization')
-    user_id = _get_user_id(auth_header=auth_header)
-    if not user_id:
+    principal = g.get("principal")
+    if not principal:
         return jsonify({"error": "Invalid token"}), 401
-    chats = await _get_chats_by_user_name(auth_header, user_id)
-    chats_view = [{
-        'technical_id': chat['technical_id'],
-        'name': chat['name'],
-        'description': chat['description'],
-        'date': "2025-01-30T23:48:21.073+00:00"
-    } for chat in chats]
-
+    chats_view = await _get_chats_by_user_name(principal.token, principal.user_id)
     return jsonify({"chats": chats_view})
 
 
 @app.route(API_PREFIX + '/chats/<technical_id>', methods=['GET'])
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def get_chat(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
-
-    dialogue = []
-    if "finished_flow" in chat.get("chat_flow", {}):
-        for item in chat["chat_flow"]["finished_flow"]:
-            if ((item.get("question") or item.get("notification")) and item.get("publish")) or item.get("answer"):
-                dialogue.append(item)
+    """
+    The chat with its dialogue. Optional query parameters page through the dialogue:
+    `limit` entries before the `before` cursor (the latest ones by default) or after the
+    `after` cursor, `header_only=true` leaves the dialogue out. A cursor is the sequence
+    number of a dialogue entry, see "page" in the response, and is never reused.
+    """
+    chat = await _get_chat_for_user(technical_id=technical_id)
+    try:
+        limit = _parse_int(request.args.get("limit"))
+        before = _parse_int(request.args.get("before"))
+        after = _parse_int(request.args.get("after"))
+    except ValueError:
+        return jsonify({"error": "limit, before and after must be integers"}), 400
+    if before is not None and after is not None:
+        return jsonify({"error": "Use either before or after"}), 400
+    if limit is not None and not 0 < limit <= MAX_DIALOGUE_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_DIALOGUE_PAGE_SIZE}"}), 400
+
     chats_view = {
         'technical_id': technical_id,
         'name': chat['name'],
         'description': chat['description'],
         'date': chat['date'],
-        'dialogue': dialogue
     }
+    if request.args.get("header_only", "false").lower() == "true":
+        return jsonify({"chat_body": chats_view})
+
+    if limit is None and before is None and after is None:
+        chats_view['dialogue'] = get_dialogue(chat)
+        return jsonify({"chat_body": chats_view})
+
+    chats_view['dialogue'], chats_view['page'] = get_dialogue_page(chat, limit or MAX_DIALOGUE_PAGE_SIZE,
+                                                                   before, after)
     return jsonify({"chat_body": chats_view})
 
 
+@app.route(API_PREFIX + '/metrics', methods=['GET'])
+@auth_required
+@rate_limit(RATE_LIMIT, timedelta(minutes=1))
+async def get_metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({
+        "auth_cache": token_validation_cache.stats(),
+        "jwt_verifier": jwt_verifier.stats(),
+        "entity_service": entity_service.stats(),
+        "chat_locks": chat_locks.stats(),
+        "question_broker": question_broker.stats(),
+    })
+
+
 @app.route(API_PREFIX + '/get_guest_token', methods=['GET'])
 # todo !!! @rate_limit(limit=3, period=timedelta(days=1))
 async def get_guest_token():
@@ -218,13 +290,12 @@ async def get_guest_token():
 # todo !! @auth_required
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def delete_chat(technical_id):
-    auth_header = request.headers.get('Authorization')
-    await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
-    entity_service.delete_item(token=auth_header,
-                               entity_model="chat",
-                               entity_version=ENTITY_VERSION,
-                               technical_id=technical_id,
-                               meta={})
+    await _get_chat_for_user(technical_id=technical_id)
+    await entity_service.delete_item(token=_get_principal().token,
+                                     entity_model="chat",
+                                     entity_version=ENTITY_VERSION,
+                                     technical_id=technical_id,
+                                     meta={})
 
     return jsonify({"message": "Chat deleted", "technical_id": technical_id})
 
@@ -232,10 +303,10 @@ async def delete_chat(technical_id):
 @app.route(API_PREFIX + '/chats', methods=['POST'])
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def add_chat():
-    auth_header = request.headers.get('Authorization')
-    user_id = _get_user_id(auth_header=auth_header)
-    if user_id.startswith('guest.'):
-        user_chats = await _get_chats_by_user_name(auth_header, user_id)
+    principal = _get_principal()
+    user_id = principal.user_id
+    if principal.is_guest:
+        user_chats = await _get_chats_by_user_name(principal.token, user_id)
         if len(user_chats) >= MAX_GUEST_CHATS:
             return jsonify({"error": "Max guest chats limit reached, please sign in to proceed"}), 403
     req_data = await request.get_json()
@@ -253,11 +324,11 @@ async def add_chat():
         },
         "messages": []
     }
-    technical_id = await entity_service.add_item(token=auth_header,
+    technical_id = await entity_service.add_item(token=principal.token,
                                                  entity_model="chat",
                                                  entity_version=ENTITY_VERSION,
                                                  entity=chat)
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
+    chat = await _get_chat_for_user(technical_id=technical_id)
     logger.info("chat_id=" + str(technical_id))
     #####todo SIMULATION!!!
 
@@ -265,8 +336,7 @@ async def add_chat():
     logger.info("=== Simulation: Successful Weather Fetch Workflow ===")
     # Launch the workflow from the initial state and run automatic transitions.
     fsm = await load_fsm()
-    current_state = asyncio.create_task(
-        flow_processor.run_workflow(fsm=fsm, technical_id=technical_id, entity=chat))
+    current_state = flow_processor.run_workflow(fsm=fsm, technical_id=technical_id, entity=chat)
 
     logger.info(f"Workflow stopped at state: {current_state}")
     #####todo
@@ -278,22 +348,95 @@ async def add_chat():
 @app.route(API_PREFIX + '/chats/<technical_id>/questions', methods=['GET'])
 @rate_limit(RATE_LIMIT, timedelta(seconds=10))
 async def get_question(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
-    questions_queue = chat.get("questions_queue", {}).get("new_questions", [])
-    return await poll_questions(auth_header, chat, questions_queue, technical_id)
+    chat = await _get_chat_for_user(technical_id=technical_id)
+    return await poll_questions(_get_principal().token, chat, technical_id)
+
+
+# pushed questions: server-sent events for one chat, resumed after the Last-Event-ID / last_seq
+@app.route(API_PREFIX + '/chats/<technical_id>/questions/stream', methods=['GET'])
+@rate_limit(RATE_LIMIT, timedelta(minutes=1))
+async def stream_questions(technical_id):
+    chat = await _get_chat_for_user(technical_id=technical_id)
+    try:
+        last_seq = _parse_int(request.headers.get("Last-Event-ID") or request.args.get("last_seq"))
+    except ValueError:
+        return jsonify({"error": "Invalid last_seq"}), 400
+    token = _get_principal().token
+    subscription = question_broker.subscribe()
+    _subscribe(subscription, chat, technical_id, last_seq)
+
+    async def events():
+        try:
+            async for event in _question_events(subscription, token):
+                if event is None:
+                    yield b": keep-alive\n\n"
+                    continue
+                _, seq, question = event
+                data = json.dumps(question, default=custom_serializer)
+                yield f"id: {seq}\nevent: question\ndata: {data}\n\n".encode("utf-8")
+        finally:
+            subscription.close()
+
+    response = await make_response(events(), {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    response.timeout = None
+    return response
+
+
+# pushed questions of several chats over one connection, the client sends
+# {"action": "subscribe" | "unsubscribe", "technical_id": ..., "last_seq": ...}
+@app.websocket(API_PREFIX + '/questions/ws')
+async def questions_websocket():
+    token = _get_principal().token
+    subscription = question_broker.subscribe()
+
+    async def send_questions():
+        try:
+            async for event in _question_events(subscription, token):
+                if event is not None:
+                    technical_id, seq, question = event
+                    await websocket.send_json({"type": "question", "technical_id": technical_id,
+                                               "seq": seq, "question": question})
+        except Exception as e:
+            logger.exception(e)
+
+    sender = asyncio.create_task(send_questions())
+    try:
+        while True:
+            message = await websocket.receive_json()
+            technical_id = message.get("technical_id")
+            try:
+                if message.get("action") == "subscribe":
+                    chat = await _get_chat_for_user(technical_id=technical_id)
+                    _subscribe(subscription, chat, technical_id, _parse_int(message.get("last_seq")))
+                    await websocket.send_json({"type": "subscribed", "technical_id": technical_id})
+                elif message.get("action") == "unsubscribe":
+                    subscription.remove(technical_id)
+                    await websocket.send_json({"type": "unsubscribed", "technical_id": technical_id})
+                else:
+                    raise ValueError(f"Unknown action: {message.get('action')}")
+            except (ChatNotFoundException, InvalidTokenException, ValueError) as e:
+                await websocket.send_json({"type": "error", "technical_id": technical_id, "error": str(e)})
+            except Exception as e:
+                logger.exception(e)
+                await websocket.send_json({"type": "error", "technical_id": technical_id, "error": str(e)})
+    finally:
+        sender.cancel()
+        subscription.close()
 
 
 @app.route(API_PREFIX + '/chats/<technical_id>/text-questions', methods=['POST'])
 @auth_required
 @rate_limit(RATE_LIMIT, timedelta(days=1))
 async def submit_question_text(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
+    chat = await _get_chat_for_user(technical_id=technical_id)
 
     req_data = await request.get_json()
     question = req_data.get('question')
-    res = await _submit_question_helper(auth_header=auth_header, chat=chat, question=question, technical_id=technical_id)
+    res = await _submit_question_helper(chat=chat, question=question, technical_id=technical_id)
     return res
 
 
@@ -301,8 +444,7 @@ async def submit_question_text(technical_id):
 @auth_required
 @rate_limit(RATE_LIMIT, timedelta(days=1))
 async def submit_question(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
+    chat = await _get_chat_for_user(technical_id=technical_id)
 
     req_data = await request.form
     req_data = req_data.to_dict()
@@ -311,8 +453,7 @@ async def submit_question(technical_id):
     user_file = file.get('file')
     if user_file.content_length > MAX_FILE_SIZE:
         return {"error": f"File size exceeds {MAX_FILE_SIZE} limit"}
-    res = await _submit_question_helper(auth_header=auth_header,
-                                        chat=chat,
+    res = await _submit_question_helper(chat=chat,
                                         question=question,
                                         technical_id=technical_id,
                                         user_file=user_file)
@@ -324,8 +465,7 @@ async def submit_question(technical_id):
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def push_notify(technical_id):
     return jsonify({"error": "OPERATION_NOT_SUPPORTED_WARNING"}), 400
-    # auth_header = request.headers.get('Authorization')
-    # chat = await _get_chat_for_user(auth_header, technical_id)
+    # chat = await _get_chat_for_user(technical_id)
     # await git_pull(chat['chat_id'])
     # return await _submit_answer_helper(technical_id, PUSH_NOTIFICATION, auth_header, chat)
 
@@ -334,43 +474,39 @@ async def push_notify(technical_id):
 @auth_required_to_proceed
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def approve(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
-    return await _submit_answer_helper(technical_id, APPROVE, auth_header, chat)
+    chat = await _get_chat_for_user(technical_id=technical_id)
+    return await _submit_answer_helper(technical_id, APPROVE, _get_principal().token, chat)
 
 
 @app.route(API_PREFIX + '/chats/<technical_id>/rollback', methods=['POST'])
 @auth_required
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def rollback(technical_id):
-    auth_header = request.headers.get('Authorization')
     req_data = await request.get_json()
     if not req_data.get('question') or not req_data.get('stack'):
         return jsonify({"error": "ADDITIONAL_QUESTION_ROLLBACK_WARNING"}), 400
     question = req_data.get('question') if req_data else None
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
-    return await rollback_dialogue_script(technical_id, auth_header, chat, question)
+    chat = await _get_chat_for_user(technical_id=technical_id)
+    return await rollback_dialogue_script(technical_id, _get_principal().token, chat, question)
 
 
 @app.route(API_PREFIX + '/chats/<technical_id>/text-answers', methods=['POST'])
 @auth_required_to_proceed
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def submit_answer_text(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
+    chat = await _get_chat_for_user(technical_id=technical_id)
     req_data = await request.get_json()
     answer = req_data.get('answer')
     if answer and len(str(answer).encode('utf-8')) > MAX_TEXT_SIZE:
         return jsonify({"error": "Answer size exceeds 1MB limit"}), 400
-    return await _submit_answer_helper(technical_id, answer, auth_header, chat)
+    return await _submit_answer_helper(technical_id, answer, _get_principal().token, chat)
 
 
 @app.route(API_PREFIX + '/chats/<technical_id>/answers', methods=['POST'])
 @auth_required_to_proceed
 @rate_limit(RATE_LIMIT, timedelta(minutes=1))
 async def submit_answer(technical_id):
-    auth_header = request.headers.get('Authorization')
-    chat = await _get_chat_for_user(request=request, auth_header=auth_header, technical_id=technical_id)
+    chat = await _get_chat_for_user(technical_id=technical_id)
     req_data = await request.form
     req_data = req_data.to_dict()
     answer = req_data.get('answer')
@@ -380,96 +516,88 @@ async def submit_answer(technical_id):
     user_file = file.get('file')
     if user_file.content_length > MAX_FILE_SIZE:
         return {"error": f"File size exceeds {MAX_FILE_SIZE} limit"}
-    return await _submit_answer_helper(technical_id, answer, auth_header, chat, user_file)
+    return await _submit_answer_helper(technical_id, answer, _get_principal().token, chat, user_file)
 
 
 
 
-async def _get_chat_for_user(auth_header, technical_id, request=None):
-    user_id = _get_user_id(auth_header=auth_header)
-    if not user_id:
-        raise InvalidTokenException()
+async def _get_chat_for_user(technical_id):
+    principal = _get_principal()
+    user_id = principal.user_id
 
-    chat = await entity_service.get_item(token=auth_header,
+    chat = await entity_service.get_item(token=principal.token,
                                          entity_model="chat",
                                          entity_version=ENTITY_VERSION,
                                          technical_id=technical_id)
 
-    if not chat and CHAT_REPOSITORY == "local":
+    if not chat and CHAT_REPOSITORY in ("local", "sqlite"):
         # todo check here
-        async with chat_lock:
-            chat = await entity_service.get_item(token=auth_header,
+        async with chat_locks.lock(technical_id):
+            chat = await entity_service.get_item(token=principal.token,
                                                  entity_model="chat",
                                                  entity_version=ENTITY_VERSION,
                                                  technical_id=technical_id)
             if not chat:
                 await clone_repo(chat_id=technical_id)
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f"{RAW_REPOSITORY_URL}/{technical_id}/entity/chat.json") as response:
-                        data = await response.text()
+                session = await http_client.get_session()
+                async with session.get(f"{RAW_REPOSITORY_URL}/{technical_id}/entity/chat.json") as response:
+                    data = await response.text()
                 chat = json.loads(data)
                 if not chat:
                     raise ChatNotFoundException()
 
-                await entity_service.add_item(token=auth_header,
+                await entity_service.add_item(token=principal.token,
                                               entity_model="chat",
                                               entity_version=ENTITY_VERSION,
                                               entity=chat)
 
     elif not chat:
         raise ChatNotFoundException()
-    # todo concurrent requests might override
     if chat["user_id"] != user_id:
-        if chat["user_id"].startswith("guest.") and not user_id.startswith("guest."):
-            chat["user_id"] = user_id
-            await entity_service.update_item(token=auth_header,
-                                             entity_model="chat",
-                                             entity_version=ENTITY_VERSION,
-                                             technical_id=technical_id,
-                                             entity=chat,
-                                             meta={})
-        else:
-            raise InvalidTokenException()
+        chat = await entity_service.update_with_retry(token=principal.token,
+                                                      entity_model="chat",
+                                                      entity_version=ENTITY_VERSION,
+                                                      technical_id=technical_id,
+                                                      mutate=functools.partial(_claim_chat, principal=principal),
+                                                      entity=chat)
 
     return chat
 
 
-def _get_user_id(auth_header):
-    try:
-        token = auth_header.split(" ")[1]
-        # Decode the JWT without verifying the signature
-        # The `verify=False` option ensures that we do not verify the signature
-        # This is useful for extracting the payload only.
-        decoded = jwt.decode(token, options={"verify_signature": False})
-        user_id = decoded.get("sub")
-        if user_id.startswith('guest.'):
-            validate_token(token)
-        return user_id
-    except jwt.InvalidTokenError:
-        return None
-
-
-async def _get_chats_by_user_name(auth_header, user_id):
-    return await entity_service.get_items_by_condition(token=auth_header,
-                                                       entity_model="chat",
-                                                       entity_version=ENTITY_VERSION,
-                                                       condition={"cyoda": {
-                                                           "operator": "AND",
-                                                           "conditions": [
-                                                               {
-                                                                   "jsonPath": "$.user_id",
-                                                                   "operatorType": "EQUALS",
-                                                                   "value": user_id,
-                                                                   "type": "simple"
-                                                               }
-                                                           ],
-                                                           "type": "group"
-                                                       },
-                                                           "local": {"key": "user_id", "value": user_id}})
-
-
-async def _submit_question_helper(auth_header, technical_id, chat, question, user_file=None):
+def _claim_chat(chat, principal):
+    """A guest's chat is taken over by the user once they sign in."""
+    if chat["user_id"] == principal.user_id:
+        # Claimed by a concurrent request
+        return False
+    if not chat["user_id"].startswith("guest.") or principal.is_guest:
+        raise InvalidTokenException()
+    chat["user_id"] = principal.user_id
+    return True
+
+
+async def _get_chats_by_user_name(token, user_id):
+    # Served by the user_id index of the local repositories and the search cache on Cyoda
+    chats = await entity_service.get_items_by_condition(token=token,
+                                                        entity_model="chat",
+                                                        entity_version=ENTITY_VERSION,
+                                                        condition={"cyoda": {
+                                                            "operator": "AND",
+                                                            "conditions": [
+                                                                {
+                                                                    "jsonPath": "$.user_id",
+                                                                    "operatorType": "EQUALS",
+                                                                    "value": user_id,
+                                                                    "type": "simple"
+                                                                }
+                                                            ],
+                                                            "type": "group"
+                                                        },
+                                                            "local": {"key": "user_id", "value": user_id}}) or []
+    return [_chat_summary(chat.get("technical_id"), chat) for chat in chats]
+
+
+async def _submit_question_helper(technical_id, chat, question, user_file=None):
     # Check if a file has been uploaded
 
     # Validate input
@@ -499,7 +627,29 @@ async def _submit_question_helper(auth_header, technical_id, chat, question, use
     return jsonify({"message": result}), 200
 
 
-async def _submit_answer_helper(technical_id, answer, auth_header, chat, user_file=None):
+async def _submit_answer_helper(technical_id, answer, token, chat, user_file=None):
+    async with chat_locks.lock(technical_id):
+        chat = await _reload_chat(token, technical_id)
+        if flow_processor.is_running(technical_id):
+            return jsonify({"message": "DESIGN_IN_PROGRESS_WARNING"}), 400
+        return await _submit_answer(technical_id, answer, token, chat, user_file)
+
+
+async def _reload_chat(token, technical_id):
+    """
+    Read the chat again once its lock is held, the copy the route loaded may predate
+    the last workflow run.
+    """
+    chat = await entity_service.get_item(token=token,
+                                         entity_model="chat",
+                                         entity_version=ENTITY_VERSION,
+                                         technical_id=technical_id)
+    if not chat:
+        raise ChatNotFoundException()
+    return chat
+
+
+async def _submit_answer(technical_id, answer, token, chat, user_file=None):
     question_queue = await _initialize_question_queue(chat=chat)
 
     if question_queue:
@@ -511,25 +661,36 @@ async def _submit_answer_helper(technical_id, answer, auth_header, chat, user_fi
     if not is_valid:
         return jsonify({"message": validated_answer}), 400
 
-    _append_wait_notification(question_queue=question_queue)
+    _append_wait_notification(technical_id=technical_id, chat=chat)
     await _update_finished_flow(chat=chat, answer=validated_answer, user_file=user_file)
     _increment_iteration(chat=chat, answer=validated_answer)
 
     await entity_service.update_item(
-        token=auth_header,
+        token=token,
         entity_model="chat",
         entity_version=ENTITY_VERSION,
         technical_id=technical_id,
         entity=chat,
         meta={}
     )
+    # Stored before the answer is acknowledged, also with write-behind
+    await entity_service.flush(entity_model="chat", entity_version=ENTITY_VERSION, technical_id=technical_id)
+    question_broker.release(technical_id)
 
     await _trigger_manual_transition(chat=chat, technical_id=technical_id)
 
     return jsonify({"message": "Answer received"}), 200
 
 
-async def rollback_dialogue_script(technical_id, auth_header, chat, question):
+async def rollback_dialogue_script(technical_id, token, chat, question):
+    async with chat_locks.lock(technical_id):
+        chat = await _reload_chat(token, technical_id)
+        if flow_processor.is_running(technical_id):
+            return jsonify({"message": "DESIGN_IN_PROGRESS_WARNING"}), 400
+        return await _rollback_dialogue_script(technical_id, token, chat, question)
+
+
+async def _rollback_dialogue_script(technical_id, token, chat, question):
     current_flow = chat["chat_flow"]["current_flow"]
     if "finished_flow" not in chat["chat_flow"]:
         chat["chat_flow"]["finished_flow"] = []
@@ -540,21 +701,25 @@ async def rollback_dialogue_script(technical_id, auth_header, chat, question):
     if not question:
         return jsonify({
             "message": "OPERATION_NOT_SUPPORTED_WARNING"}), 400
-    event = finished_flow.pop()
-    while finished_flow and (not event.get("question") or event.get("question") != question):
+    # Back to the last entry asking `question` (or the first entry), the dialogue view is cut with the flow
+    position = len(finished_flow) - 1
+    while position > 0 and (not finished_flow[position].get("question")
+                            or finished_flow[position].get("question") != question):
+        event = finished_flow[position]
         if event.get("stack") and (
                 not event.get('iteration') or (event.get('iteration') and event.get('iteration') < 2)):
             new_event = copy.deepcopy(event)
             new_event['iteration'] = 0
             current_flow.append(new_event)
-        event = finished_flow.pop()
-    finished_flow.append(event)
-    await entity_service.update_item(token=auth_header,
+        position -= 1
+    truncate_flow(chat, position + 1)
+    await entity_service.update_item(token=token,
                                      entity_model="chat",
                                      entity_version=ENTITY_VERSION,
                                      technical_id=technical_id,
                                      entity=chat,
                                      meta={})
+    await entity_service.flush(entity_model="chat", entity_version=ENTITY_VERSION, technical_id=technical_id)
     return jsonify({"message": "Answer received"}), 200
 
 
@@ -571,7 +736,7 @@ def _validate_answer(answer, user_file):
     return True, answer
 
 
-def _append_wait_notification(question_queue):
+def _append_wait_notification(technical_id, chat):
     wait_notification = {
         "notification": f"Thank you for your answer! {"DESIGN_PLEASE_WAIT"}",
         "prompt": {},
@@ -580,13 +745,12 @@ def _append_wait_notification(question_queue):
         "iteration": 0,
         "max_iteration": 0
     }
-    question_queue.append(wait_notification)
+    question_broker.publish_question(technical_id, chat, wait_notification)
 
 
 async def _update_finished_flow(chat, answer, user_file):
     answer = await get_user_message(message=answer, user_file=user_file)
-    finished_stack = chat["chat_flow"].setdefault("finished_flow", [])
-    finished_stack.append({
+    append_to_flow(chat, {
         "type": "answer",
         "answer": answer,
         "publish": True,
@@ -618,35 +782,99 @@ async def _trigger_manual_transition(chat, technical_id):
     ]
 
     if manual_events:
-        asyncio.create_task(flow_processor.trigger_manual_transition(
+        flow_processor.trigger_manual_transition(
             current_state=current_state,
             event=manual_events[0],
             entity=chat,
             fsm=fsm,
             technical_id=technical_id
-        ))
+        )
 
 
 
 
-async def poll_questions(auth_header, chat, questions_queue, technical_id):
+async def poll_questions(token, chat, technical_id):
     try:
-        questions_to_user = []
-        while questions_queue:
-            _event = questions_queue.pop(0)
-            questions_to_user.append(_event)
-        if len(questions_to_user) > 0:
-            await entity_service.update_item(token=auth_header,
-                                             entity_model="chat",
-                                             entity_version=ENTITY_VERSION,
-                                             technical_id=technical_id,
-                                             entity=chat,
-                                             meta={})
-        return jsonify({"questions": questions_to_user}), 200
+        _, questions = await _drain_questions(token, technical_id, chat)
+        return jsonify({"questions": [question for _, question in questions]}), 200
     except Exception as e:
         logger.exception(e)
         return jsonify({"questions": []}), 200  # No Content
 
 
+
+async def _drain_questions(token, technical_id, chat=None, up_to_seq=None):
+    """
+    Take the undelivered questions (up to `up_to_seq`) out of the stored chat, returns
+    the chat's last sequence number and the (seq, question) taken.
+    """
+    taken = []
+    last_seq = [0]
+
+    def take(entity):
+        # Re-applied to a fresh copy of the chat after a conflict
+        taken[:] = take_questions(entity, up_to_seq)
+        last_seq[0] = entity["questions_queue"]["last_seq"]
+        return bool(taken)
+
+    await entity_service.update_with_retry(token=token,
+                                           entity_model="chat",
+                                           entity_version=ENTITY_VERSION,
+                                           technical_id=technical_id,
+                                           mutate=take,
+                                           entity=chat)
+    return last_seq[0], taken
+
+
+def _parse_int(value):
+    return int(value) if value not in (None, "") else None
+
+
+def _subscribe(subscription, chat, technical_id, last_seq=None):
+    """
+    Stream the chat's questions after `last_seq`, by default the ones not delivered yet.
+    They stay queued in the chat until they are sent.
+    """
+    stored_last_seq, pending = peek_questions(chat)
+    if last_seq is None:
+        last_seq = pending[0][0] - 1 if pending else stored_last_seq
+    subscription.add(technical_id, last_seq, pending)
+
+
+async def _question_events(subscription, token):
+    """
+    Yield the subscription's (technical_id, seq, question), or None as a keep-alive when
+    nothing came for a while. Questions are taken out of the stored queue once the
+    consumer asks for more, i.e. after they were sent.
+    """
+    while True:
+        event = await subscription.get(QUESTION_STREAM_POLL_INTERVAL)
+        if event is None:
+            # Questions queued by another worker process only show up in the stored chat
+            for technical_id in subscription.chats:
+                chat = await entity_service.get_item(token=token,
+                                                     entity_model="chat",
+                                                     entity_version=ENTITY_VERSION,
+                                                     technical_id=technical_id)
+                if not chat:
+                    logger.info(f"Stopped streaming questions of {technical_id}: the chat no longer exists")
+                    subscription.remove(technical_id)
+                    continue
+                _, pending = peek_questions(chat)
+                for seq, question in pending:
+                    subscription.deliver(technical_id, seq, question)
+            yield None
+            continue
+        sent = {}
+        for technical_id, seq, question in [event, *subscription.get_ready()]:
+            yield technical_id, seq, question
+            sent[technical_id] = seq
+        for technical_id, seq in sent.items():
+            try:
+                await _drain_questions(token, technical_id, up_to_seq=seq)
+            except ConflictException as e:
+                logger.warning(f"Could not remove delivered questions of {technical_id}: {e}")
+
+
 if __name__ == '__main__':
     app.run(use_reloader=False, debug=True, host='0.0.0.0', port=5000, threaded=True)
@@ -3,6 +3,7 @@ import logging
 import requests
 
 from common.config import config
+from common.util.utils import send_get_request
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -28,4 +29,13 @@ logger = logging.getLogger(__name__)
 #
 #     except Exception as e:
 #         logger.error(f"An error occurred: {e}")
-#         return None
\ No newline at end of file
+#         return None
+
+
+async def validate_remote_token(token) -> bool:
+    """Validate a signed-in user token against the Cyoda API."""
+    response = await send_get_request(token, config.API_URL, "v1")
+    # todo
+    if not response or (response.get("status") and response.get("status") == 401):
+        return False
+    return True
@@ -0,0 +1,133 @@
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import jwt
+
+from common.config.config import AUTH_JWKS_URL, AUTH_JWT_AUDIENCE, AUTH_JWT_ISSUER, AUTH_JWT_ALGORITHMS, \
+    AUTH_JWKS_TTL, AUTH_JWKS_MIN_REFRESH_INTERVAL
+from common.exception.exceptions import InvalidTokenException, UnknownSigningKeyException
+from common.util.http_client import get_http_session
+from common.util.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class JwtVerifier:
+    """
+    Verifies signed-in user JWTs in-process against the issuer's cached public keys.
+
+    The JWKS is fetched once and refreshed after `ttl` seconds, or earlier when a
+    token references an unknown key id (rate limited by `min_refresh_interval` so
+    forged key ids cannot hammer the issuer). Tokens whose key id is still unknown
+    after a refresh raise UnknownSigningKeyException so callers can fall back to
+    remote validation.
+    """
+
+    def __init__(self,
+                 jwks_url: str = AUTH_JWKS_URL,
+                 audience: Optional[str] = AUTH_JWT_AUDIENCE,
+                 issuer: Optional[str] = AUTH_JWT_ISSUER,
+                 algorithms: List[str] = AUTH_JWT_ALGORITHMS,
+                 ttl: float = AUTH_JWKS_TTL,
+                 min_refresh_interval: float = AUTH_JWKS_MIN_REFRESH_INTERVAL,
+                 jwks: Optional[Dict[str, Any]] = None):
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.issuer = issuer
+        self.algorithms = algorithms
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._fetched_at = None
+        self._single_flight = SingleFlight()
+        self.verified = 0
+        self.rejected = 0
+        self.unknown_keys = 0
+        self.refreshes = 0
+        if jwks is not None:
+            self._set_keys(jwks)
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """Return the verified claims of `token` or raise InvalidTokenException."""
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError:
+            self.rejected += 1
+            raise InvalidTokenException()
+
+        key = await self._get_key(header.get("kid"))
+        if key is None:
+            self.unknown_keys += 1
+            raise UnknownSigningKeyException()
+
+        try:
+            claims = jwt.decode(token,
+                                key=key.key,
+                                algorithms=self.algorithms,
+                                audience=self.audience,
+                                issuer=self.issuer,
+                                options={"require": ["exp", "sub"],
+                                         "verify_aud": self.audience is not None})
+        except jwt.InvalidTokenError as e:
+            logger.info(f"Offline token verification failed: {e}")
+            self.rejected += 1
+            raise InvalidTokenException()
+        self.verified += 1
+        return claims
+
+    async def _get_key(self, kid: Optional[str]) -> Optional[jwt.PyJWK]:
+        if self._is_stale():
+            await self._refresh()
+        elif kid not in self._keys and self._can_refresh():
+            # The issuer may have rotated its keys
+            await self._refresh()
+        if kid is None and len(self._keys) == 1:
+            return next(iter(self._keys.values()))
+        return self._keys.get(kid)
+
+    def _is_stale(self) -> bool:
+        return self._fetched_at is None or time.monotonic() - self._fetched_at > self.ttl
+
+    def _can_refresh(self) -> bool:
+        return self._fetched_at is None or time.monotonic() - self._fetched_at > self.min_refresh_interval
+
+    async def _refresh(self):
+        await self._single_flight.do("jwks", self._fetch_keys)
+
+    async def _fetch_keys(self):
+        try:
+            session = await get_http_session()
+            async with session.get(self.jwks_url) as response:
+                response.raise_for_status()
+                jwks = await response.json(content_type=None)
+            self._set_keys(jwks)
+            self.refreshes += 1
+            logger.info(f"Loaded {len(self._keys)} signing keys from {self.jwks_url}")
+        except Exception as e:
+            # Keep serving with the previous keys, retry after min_refresh_interval
+            logger.error(f"Failed to fetch signing keys from {self.jwks_url}: {e}")
+            self._fetched_at = time.monotonic() - self.ttl + self.min_refresh_interval
+
+    def _set_keys(self, jwks: Dict[str, Any]):
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                key = jwt.PyJWK.from_dict(jwk)
+            except jwt.PyJWTError as e:
+                logger.warning(f"Skipping unsupported signing key {jwk.get('kid')}: {e}")
+                continue
+            keys[key.key_id] = key
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._keys),
+            "verified": self.verified,
+            "rejected": self.rejected,
+            "unknown_keys": self.unknown_keys,
+            "refreshes": self.refreshes,
+        }
@@ -0,0 +1,55 @@
+import functools
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import jwt
+
+from common.config.config import AUTH_SECRET_KEY, PRINCIPAL_CACHE_SIZE
+
+GUEST_PREFIX = "guest."
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The caller of the current request, resolved once from the Authorization header."""
+    user_id: str
+    is_guest: bool
+    token: str
+    expires_at: Optional[int] = None
+
+
+def get_bearer_token(auth_header: Optional[str]) -> Optional[str]:
+    if not auth_header:
+        return None
+    parts = auth_header.split(" ")
+    return parts[1] if len(parts) > 1 else None
+
+
+@functools.lru_cache(maxsize=PRINCIPAL_CACHE_SIZE)
+def _decode_token(token: str) -> dict:
+    # Signed-in tokens are only decoded here, they are validated by the auth decorators.
+    claims = jwt.decode(token, options={"verify_signature": False})
+    if str(claims.get("sub", "")).startswith(GUEST_PREFIX):
+        # Guest tokens are issued by us, check the signature (expiry is checked per request)
+        claims = jwt.decode(token, AUTH_SECRET_KEY, algorithms=["HS256"], options={"verify_exp": False})
+    return claims
+
+
+def resolve_principal(auth_header: Optional[str]) -> Optional[Principal]:
+    """Return the principal for `auth_header` or None if the token is missing or invalid."""
+    token = get_bearer_token(auth_header)
+    if not token:
+        return None
+    try:
+        claims = _decode_token(token)
+    except jwt.InvalidTokenError:
+        return None
+    user_id = claims.get("sub")
+    if not user_id:
+        return None
+    is_guest = user_id.startswith(GUEST_PREFIX)
+    expires_at = claims.get("exp")
+    if is_guest and expires_at is not None and expires_at <= time.time():
+        return None
+    return Principal(user_id=user_id, is_guest=is_guest, token=token, expires_at=expires_at)
@@ -0,0 +1,88 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+import jwt
+
+from common.config.config import AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL, AUTH_CACHE_NEGATIVE_TTL
+from common.util.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class TokenValidationCache:
+    """
+    Bounded LRU cache of remote token validation results.
+
+    Entries are keyed by a SHA-256 hash of the token, valid tokens are cached for
+    `ttl` seconds but never past the JWT `exp` claim, rejected tokens are cached
+    for `negative_ttl` seconds. Concurrent checks of the same uncached token share
+    one call to `validator`.
+    """
+
+    def __init__(self,
+                 validator: Callable[[str], Awaitable[bool]],
+                 max_size: int = AUTH_CACHE_MAX_SIZE,
+                 ttl: float = AUTH_CACHE_TTL,
+                 negative_ttl: float = AUTH_CACHE_NEGATIVE_TTL):
+        self.validator = validator
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        self._single_flight = SingleFlight()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    async def is_valid(self, token: str) -> bool:
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        entry = self._entries.get(key)
+        if entry is not None:
+            is_valid, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if not is_valid:
+                    self.negative_hits += 1
+                return is_valid
+            del self._entries[key]
+
+        self.misses += 1
+        return await self._single_flight.do(key, lambda: self._validate(key, token))
+
+    async def _validate(self, key: str, token: str) -> bool:
+        is_valid = bool(await self.validator(token))
+        ttl = self._get_ttl(token) if is_valid else self.negative_ttl
+        if ttl > 0:
+            self._entries[key] = (is_valid, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return is_valid
+
+    def _get_ttl(self, token: str) -> float:
+        try:
+            exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.InvalidTokenError:
+            return 0
+        if exp is None:
+            return self.ttl
+        return min(self.ttl, exp - time.time())
+
+    def invalidate(self, token: str):
+        self._entries.pop(hashlib.sha256(token.encode("utf-8")).hexdigest(), None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "remote_calls": self._single_flight.calls,
+            "coalesced": self._single_flight.shared,
+        }
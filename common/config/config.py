@@ -1,5 +1,6 @@
 import base64
 import os
+import tempfile
 import logging
 from dotenv import load_dotenv
 
@@ -46,8 +47,12 @@ NUM_MOCK_ARR_ITEMS = int(get_env("NUM_MOCK_ARR_ITEMS"))
 REPOSITORY_NAME = get_env("REPOSITORY_URL").split('/')[-1].replace('.git', '')
 CHAT_REPOSITORY = os.getenv("CHAT_REPOSITORY", "local")
 ENABLE_AUTH = os.getenv("ENABLE_AUTH", "true").lower() == "true"
+# GET /metrics (internal cache, lock and queue statistics, signed-in users only)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
 MAX_TEXT_SIZE = 50 * 1024  # limit text size to 50KB
 MAX_FILE_SIZE = 500 * 1024  # limit file size to 500KB
+MAX_DIALOGUE_PAGE_SIZE = int(os.getenv("MAX_DIALOGUE_PAGE_SIZE", 200))  # dialogue entries per GET /chats/<id> page
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 64 * 1024))  # multipart uploads are streamed in chunks of this size
 USER_FILES_DIR_NAME = "entity/user_files"
 RAW_REPOSITORY_URL = get_env("RAW_REPOSITORY_URL")
 GOOGLE_SEARCH_KEY = get_env("GOOGLE_SEARCH_KEY")
@@ -60,4 +65,89 @@ CYODA_DEPLOY_DICT = {
 }
 MAX_IPS_PER_DEVICE_BEFORE_BLOCK=int(os.getenv("MAX_IPS_PER_DEVICE_BEFORE_BLOCK", 300))
 MAX_IPS_PER_DEVICE_BEFORE_ALARM=int(os.getenv("MAX_IPS_PER_DEVICE_BEFORE_ALARM", 100))
-MAX_SESSIONS_PER_IP=int(os.getenv("MAX_SESSIONS_PER_IP", 100))
\ No newline at end of file
+MAX_SESSIONS_PER_IP=int(os.getenv("MAX_SESSIONS_PER_IP", 100))
+
+# Shared aiohttp client (connection pool) settings
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 30))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 120))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", 300))
+
+# Remote token validation cache
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 300))
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", 10))
+
+# Offline verification of signed-in user tokens against the issuer's public keys
+AUTH_OFFLINE_VERIFICATION = os.getenv("AUTH_OFFLINE_VERIFICATION", "false").lower() == "true"
+AUTH_JWKS_URL = os.getenv("AUTH_JWKS_URL", f"{CYODA_API_URL}/.well-known/jwks.json")
+AUTH_JWT_AUDIENCE = os.getenv("AUTH_JWT_AUDIENCE") or None
+AUTH_JWT_ISSUER = os.getenv("AUTH_JWT_ISSUER") or None
+AUTH_JWT_ALGORITHMS = os.getenv("AUTH_JWT_ALGORITHMS", "RS256,ES256").split(",")
+AUTH_JWKS_TTL = float(os.getenv("AUTH_JWKS_TTL", 3600))
+AUTH_JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("AUTH_JWKS_MIN_REFRESH_INTERVAL", 60))
+
+# Parsed request principals (decoded tokens) kept in memory
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+
+# Optional read-through entity cache in the entity service. Only safe when this process
+# is the only writer of the cached entities (e.g. a single worker in front of Cyoda).
+ENTITY_CACHE_ENABLED = os.getenv("ENTITY_CACHE_ENABLED", "false").lower() == "true"
+ENTITY_CACHE_MAX_BYTES = int(os.getenv("ENTITY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", 60))
+ENTITY_CACHE_MODEL_TTLS = os.getenv("ENTITY_CACHE_MODEL_TTLS", "")  # e.g. "chat=300,user=30"
+
+# Write-behind for update_item: consecutive updates of one entity within this window (ms)
+# are merged into a single repository write. 0 disables write-behind.
+ENTITY_WRITE_BEHIND_WINDOW_MS = int(os.getenv("ENTITY_WRITE_BEHIND_WINDOW_MS", 0))
+# Attempts of a buffered write (retried one window apart) before its update is dropped
+ENTITY_WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("ENTITY_WRITE_BEHIND_MAX_ATTEMPTS", 3))
+
+# Delta persistence: update_item sends a JSON Patch against the last persisted state when a
+# remote repository supports it. Cyoda patches are only attempted when CYODA_JSON_PATCH_ENABLED
+# is set. The persisted states are kept up to ENTITY_PATCH_BASELINES_MAX_BYTES of JSON.
+ENTITY_PATCH_ENABLED = os.getenv("ENTITY_PATCH_ENABLED", "true").lower() == "true"
+ENTITY_PATCH_BASELINES_MAX_BYTES = int(os.getenv("ENTITY_PATCH_BASELINES_MAX_BYTES", 16 * 1024 * 1024))
+CYODA_JSON_PATCH_ENABLED = os.getenv("CYODA_JSON_PATCH_ENABLED", "false").lower() == "true"
+
+# Optimistic concurrency: attempts of update_with_retry before a conflict is given up
+ENTITY_UPDATE_MAX_ATTEMPTS = int(os.getenv("ENTITY_UPDATE_MAX_ATTEMPTS", 5))
+
+# Pushed questions (SSE / websocket): questions kept per chat for resuming a stream, chats
+# that keep them, and how often a stream re-reads the stored queue and sends a keep-alive
+QUESTION_STREAM_BUFFER = int(os.getenv("QUESTION_STREAM_BUFFER", 20))
+QUESTION_STREAM_MAX_CHANNELS = int(os.getenv("QUESTION_STREAM_MAX_CHANNELS", 1000))
+QUESTION_STREAM_POLL_INTERVAL = float(os.getenv("QUESTION_STREAM_POLL_INTERVAL", 15))
+
+# Memory budget of the local (in-memory) repository: recently used entities are kept as
+# objects, colder ones compressed, the rest is spilled to files under INMEMORY_SPILL_DIR
+INMEMORY_HOT_MAX_BYTES = int(os.getenv("INMEMORY_HOT_MAX_BYTES", 64 * 1024 * 1024))
+INMEMORY_WARM_MAX_BYTES = int(os.getenv("INMEMORY_WARM_MAX_BYTES", 64 * 1024 * 1024))
+INMEMORY_SPILL_DIR = os.getenv("INMEMORY_SPILL_DIR", os.path.join(tempfile.gettempdir(), "ai_assistant_spill"))
+# Persistence of the local repository: mutations are appended to a log under this directory
+# (disabled when empty) and compacted into a snapshot every INMEMORY_SNAPSHOT_EVERY records
+# or INMEMORY_SNAPSHOT_INTERVAL seconds
+INMEMORY_PERSISTENCE_DIR = os.getenv("INMEMORY_PERSISTENCE_DIR", "")
+INMEMORY_SNAPSHOT_EVERY = int(os.getenv("INMEMORY_SNAPSHOT_EVERY", 1000))
+INMEMORY_SNAPSHOT_INTERVAL = float(os.getenv("INMEMORY_SNAPSHOT_INTERVAL", 300))
+INMEMORY_LOG_FSYNC = os.getenv("INMEMORY_LOG_FSYNC", "false").lower() == "true"
+
+# SQLite repository (CHAT_REPOSITORY=sqlite), shared by all worker processes on the machine
+SQLITE_PATH = os.getenv("SQLITE_PATH", "ai_assistant.db")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 4))
+
+# Cyoda snapshot search polling
+CYODA_SEARCH_TIMEOUT = float(os.getenv("CYODA_SEARCH_TIMEOUT", 60))
+CYODA_SEARCH_MIN_POLL_MS = int(os.getenv("CYODA_SEARCH_MIN_POLL_MS", 50))
+CYODA_SEARCH_MAX_POLL_MS = int(os.getenv("CYODA_SEARCH_MAX_POLL_MS", 2000))
+CYODA_SEARCH_PAGE_SIZE = int(os.getenv("CYODA_SEARCH_PAGE_SIZE", 100))
+CYODA_SEARCH_CACHE_TTL = float(os.getenv("CYODA_SEARCH_CACHE_TTL", 10))
+CYODA_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("CYODA_SEARCH_CACHE_MAX_ENTRIES", 1000))
+CYODA_FETCH_CONCURRENCY = int(os.getenv("CYODA_FETCH_CONCURRENCY", 8))
+CYODA_BULK_CHUNK_SIZE = int(os.getenv("CYODA_BULK_CHUNK_SIZE", 100))
+CYODA_BULK_CONCURRENCY = int(os.getenv("CYODA_BULK_CONCURRENCY", 4))
+CYODA_INIT_CONCURRENCY = int(os.getenv("CYODA_INIT_CONCURRENCY", 8))
+CYODA_MODEL_REGISTRY_FILE = os.getenv("CYODA_MODEL_REGISTRY_FILE", ".cyoda_model_registry.json")
@@ -14,4 +14,16 @@ class RequestLimitExceededException(Exception):
     def __init__(self, message="Request limit exceeded"):
         self.message = message
         self.status_code = 429
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class UnknownSigningKeyException(Exception):
+    def __init__(self, message="Unknown token signing key"):
+        self.message = message
+        self.status_code = 401
+        super().__init__(self.message)
+
+class ConflictException(Exception):
+    def __init__(self, message="Entity was modified concurrently"):
+        self.message = message
+        self.status_code = 409
+        super().__init__(self.message)
@@ -1,17 +1,41 @@
 from abc import abstractmethod
 from enum import Enum
-from typing import List, Any, Optional
+from typing import List, Any, Optional, AsyncIterator
 
+from common.exception.exceptions import ConflictException
 from common.repository.repository import Repository
 
+# Every write increments the version stored in this field of the entity
+VERSION_FIELD = "version"
+
 
 class DBKeys(Enum):
     CYODA = "CYODA"
 
+
+def get_version(entity) -> int:
+    """Version of a stored entity, entities written before versioning count as 0."""
+    return (entity or {}).get(VERSION_FIELD) or 0
+
+
+def check_version(technical_id, stored, expected_version):
+    """Raise ConflictException if `expected_version` is set and the stored entity is at another version."""
+    if expected_version is None:
+        return
+    if stored is None:
+        raise ConflictException(f"Entity {technical_id} no longer exists")
+    if get_version(stored) != expected_version:
+        raise ConflictException(f"Entity {technical_id} is at version {get_version(stored)}, "
+                                f"expected {expected_version}")
+
 class CrudRepository(Repository):
     """
     Abstract base class defining a repository interface for CRUD operations.
     """
+    # Whether the store is reached over the network and hands out copies, local stores
+    # hand out the live entity that callers modify in place
+    remote = False
+
     @abstractmethod
     async def get_meta(self, *args, **kwargs):
         return {}
@@ -107,6 +131,14 @@ class CrudRepository(Repository):
         """
         pass
 
+    async def iter_all_by_criteria(self, meta, criteria: Any, page_size: int = None) -> AsyncIterator[Any]:
+        """
+        Iterates over all entities matching the criteria, repositories that can page
+        through large result sets override this to keep memory bounded.
+        """
+        for entity in await self.find_all_by_criteria(meta, criteria) or []:
+            yield entity
+
     @abstractmethod
     async def save(self, meta, entity: Any) -> Any:
         """
@@ -117,20 +149,35 @@ class CrudRepository(Repository):
     @abstractmethod
     async def save_all(self, meta, entities: List[Any]) -> List[Any]:
         """
-        Saves all given entities.
+        Saves all given entities, returns a {"technical_id", "success", "error"} result per entity.
         """
         pass
 
     @abstractmethod
     async def update(self, meta, id, entity: Any) -> Any:
         """
-        Saves all given entities.
+        Updates the entity and increments its version. With `expected_version` in meta
+        the update only happens if the stored entity is still at that version, otherwise
+        ConflictException is raised.
+        """
+        pass
+
+    async def patch(self, meta, id, patch: List[dict], entity: Any) -> Any:
+        """
+        Applies a JSON Patch (RFC 6902) to a stored entity, `entity` is the full new state.
+        Raises NotImplementedError if the backend can't apply patches.
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """
+        Releases resources and persists pending state, called on shutdown.
         """
         pass
 
     @abstractmethod
     async def update_all(self, meta, entities: List[Any]) -> List[Any]:
         """
-        Saves all given entities.
+        Updates all given entities (by their technical_id), returns a result per entity.
         """
         pass
\ No newline at end of file
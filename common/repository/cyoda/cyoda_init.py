@@ -1,24 +1,87 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
 from pathlib import Path
 
-from common.config.config import ENTITY_VERSION
+import aiofiles
+
+from common.config.config import ENTITY_VERSION, CYODA_INIT_CONCURRENCY, CYODA_MODEL_REGISTRY_FILE
 from common.repository.cyoda.cyoda_repository import CyodaRepository
 
+logger = logging.getLogger(__name__)
+
 cyoda_repository = CyodaRepository()
 
-def init_cyoda(token):
-    entity_dir = Path(__file__).resolve().parent.parent.parent.parent / 'entity'
 
+def _find_entity_models(entity_dir: Path):
     for json_file in entity_dir.glob('*/**/*.json'):
-    # Ensure the JSON file is in an immediate subdirectory
+        # Ensure the JSON file is in an immediate subdirectory
         if json_file.parent.parent.name != entity_dir.name or json_file.parent.name != json_file.name.replace(".json", ""):
             continue
+        yield json_file
+
+
+def _load_registry(path: str) -> dict:
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable model registry {path}: {e}")
+        return {}
+
+
+def _save_registry(path: str, registry: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(registry, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+async def _register_model(token, json_file: Path, registry: dict, semaphore: asyncio.Semaphore):
+    entity_name = json_file.name.replace(".json", "")
+    async with aiofiles.open(json_file, 'r') as file:
+        entity = await file.read()
+    schema_hash = hashlib.sha256(entity.encode("utf-8")).hexdigest()
+    registry_key = f"{entity_name}/{ENTITY_VERSION}"
+    if registry.get(registry_key) == schema_hash:
+        return False
+
+    async with semaphore:
+        if not await cyoda_repository._model_exists(token, entity_name, ENTITY_VERSION):
+            response = await cyoda_repository._save_entity_schema(token, entity_name, ENTITY_VERSION, entity)
+            if not response or "error" in response:
+                raise Exception(f"Saving schema failed: {response}")
+            response = await cyoda_repository._lock_entity_schema(token, entity_name, ENTITY_VERSION, None)
+            if not response or "error" in response:
+                # Not recorded, the next startup tries again
+                raise Exception(f"Locking schema failed: {response}")
+    registry[registry_key] = schema_hash
+    return True
+
+
+async def init_cyoda(token, registry_file: str = CYODA_MODEL_REGISTRY_FILE):
+    """
+    Register the entity models found under entity/<name>/<name>.json with Cyoda.
+
+    Models are checked concurrently (at most CYODA_INIT_CONCURRENCY at a time) and every
+    (model, version, schema hash) that is known to be registered is recorded in
+    `registry_file`, so later startups skip models that haven't changed.
+    """
+    entity_dir = Path(__file__).resolve().parent.parent.parent.parent / 'entity'
+    registry = await asyncio.to_thread(_load_registry, registry_file)
+    semaphore = asyncio.Semaphore(CYODA_INIT_CONCURRENCY)
+    json_files = list(_find_entity_models(entity_dir))
 
-        try:
-            with open(json_file, 'r') as file:
-                entity = file.read()
-                entity_name = json_file.name.replace(".json", "")
-                if not cyoda_repository._model_exists(token, entity_name, ENTITY_VERSION):
-                    cyoda_repository._save_entity_schema(token, entity_name, ENTITY_VERSION, entity)
-                    cyoda_repository._lock_entity_schema(token, entity_name, ENTITY_VERSION, None)
-        except Exception as e:
-            print(f"Error reading {json_file}: {e}")
+    results = await asyncio.gather(*(_register_model(token, json_file, registry, semaphore)
+                                     for json_file in json_files), return_exceptions=True)
+    for json_file, result in zip(json_files, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error registering {json_file}: {result}")
+    if any(result is True for result in results):
+        await asyncio.to_thread(_save_registry, registry_file, registry)
+    logger.info(f"Checked {len(json_files)} entity models, {sum(result is True for result in results)} updated")
+    return results
@@ -1,16 +1,54 @@
+import asyncio
+import copy
+import functools
 import queue
 import threading
-from typing import List
-from common.config.config import API_URL
-from common.repository.crud_repository import CrudRepository
+from typing import List, AsyncIterator
+from common.config.config import API_URL, CYODA_JSON_PATCH_ENABLED, CYODA_SEARCH_PAGE_SIZE, \
+    CYODA_FETCH_CONCURRENCY, CYODA_BULK_CHUNK_SIZE, CYODA_BULK_CONCURRENCY
+from common.repository.crud_repository import CrudRepository, VERSION_FIELD, check_version, get_version
+from common.repository.cyoda.search_cache import SearchResultCache, condition_key
+from common.repository.cyoda.search_poller import SnapshotSearchPoller
+from common.util.keyed_lock import KeyedLock
+from common.util.single_flight import SingleFlight
 from common.util.utils import *
 
 logger = logging.getLogger('quart')
 
 
+def _bulk_result(technical_id, error=None) -> dict:
+    return {"technical_id": technical_id, "success": error is None, "error": error}
+
+
+def _item_id(item):
+    entity = item[1] if isinstance(item, tuple) else item
+    return entity.get("technical_id") if isinstance(entity, dict) else None
+
+
+def _invalidates_searches(method):
+    """Drop cached searches of the model once a write to it has finished (or failed)."""
+
+    @functools.wraps(method)
+    async def wrapper(self, meta, *args, **kwargs):
+        try:
+            return await method(self, meta, *args, **kwargs)
+        finally:
+            self._search_cache.invalidate(meta["entity_model"], meta["entity_version"])
+
+    return wrapper
+
+
+def _get_by_json_path(entity, json_path):
+    value = entity
+    for part in json_path.lstrip("$").strip(".").split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
 class CyodaRepository(CrudRepository):
     _instance = None
     _lock = threading.Lock()  # Lock for thread safety
+    remote = True
 
     def __new__(cls):
         logger.info("initializing CyodaService")
@@ -18,6 +56,10 @@ class CyodaRepository(CrudRepository):
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super(CyodaRepository, cls).__new__(cls)
+                    cls._instance._search_poller = SnapshotSearchPoller()
+                    cls._instance._search_cache = SearchResultCache()
+                    cls._instance._search_flight = SingleFlight(clone=copy.deepcopy)
+                    cls._instance._update_locks = KeyedLock()
         return cls._instance
 
     def __init__(self):
@@ -29,14 +71,18 @@ class CyodaRepository(CrudRepository):
     async def count(self, meta) -> int:
         pass
 
+    @_invalidates_searches
     async def delete_all(self, meta) -> None:
-        pass
+        return await self._delete_all_entities(meta["token"], meta["entity_model"], meta["entity_version"])
 
-    async def delete_all_entities(self, meta, entities: List[Any]) -> None:
-        pass
+    @_invalidates_searches
+    async def delete_all_entities(self, meta, entities: List[Any]) -> List[dict]:
+        ids = [entity.get("technical_id") if isinstance(entity, dict) else None for entity in entities]
+        return await self._delete_by_ids(meta, ids)
 
-    async def delete_all_by_key(self, meta, keys: List[Any]) -> None:
-        pass
+    @_invalidates_searches
+    async def delete_all_by_key(self, meta, keys: List[Any]) -> List[dict]:
+        return await self._delete_by_ids(meta, keys)
 
     async def delete_by_key(self, meta, key: Any) -> None:
         pass
@@ -49,8 +95,18 @@ class CyodaRepository(CrudRepository):
         return entities
 
     async def find_all_by_key(self, meta, keys: List[Any]) -> List[Any]:
-        ids = await self._get_all_by_ids(meta, keys)
-        return ids
+        """
+        Load the entities for all `keys` at once, in key order.
+
+        With `meta["key_path"]` (e.g. "$.user_id") the keys are matched by one search with
+        an OR condition, otherwise they are technical ids fetched directly in parallel
+        (missing ids give None at their position).
+        """
+        if not keys:
+            return []
+        if meta.get("key_path"):
+            return await self._get_all_by_key_path(meta, meta["key_path"], keys)
+        return await self._get_all_by_ids(meta, keys)
 
     async def find_by_key(self, meta, key: Any) -> Optional[Any]:
         res = await self._get_by_key(meta, key)
@@ -62,37 +118,135 @@ class CyodaRepository(CrudRepository):
 
     async def find_all_by_criteria(self, meta, criteria: Any) -> Optional[Any]:
         try:
-            resp = await self._search_entities(meta, criteria)
-            if resp['page']['totalElements'] == 0:
-                # resp = {'page': {'number': 0, 'size': 10, 'totalElements': 0, 'totalPages': 0}}
-                return []
             # resp = {'_embedded': {'objectNodes': [{'id': 'f04bce86-89a9-11b2-aa0c-169608d9bc9e', 'tree': {'email': '4126cf85-61b6-48ec-b7bc-89fc1999d9b9@q.q', 'name': 'test', 'role': 'Start-up', 'user_id': '1703b76f-8b2f-11ef-9910-40c2ba0ac9eb'}}]}, 'page': {'number': 0, 'size': 10, 'totalElements': 1, 'totalPages': 1}}
-            #entities = resp["_embedded"]["objectNodes"]
-            result_entities = await self._convert_to_entities(resp)
-            return result_entities
+            if not self._search_cache.enabled:
+                return [entity async for entity in self.iter_all_by_criteria(meta, criteria)]
+            key = condition_key(meta["entity_model"], meta["entity_version"], criteria)
+            cached = self._search_cache.get(key)
+            if cached is not None:
+                return cached
+            # Identical searches running at the same time share one snapshot
+            return await self._search_flight.do(key, lambda: self._search_and_cache(meta, criteria, key))
         except Exception as e:
             logger.exception(e)
             return []
 
+    async def _search_and_cache(self, meta, criteria, key):
+        generation = self._search_cache.generation(meta["entity_model"], meta["entity_version"])
+        result = [entity async for entity in self.iter_all_by_criteria(meta, criteria)]
+        self._search_cache.put(key, meta["entity_model"], meta["entity_version"], result, generation)
+        return result
+
+    async def iter_all_by_criteria(self, meta, criteria: Any, page_size: int = None) -> AsyncIterator[Any]:
+        snapshot_id = await self._create_snapshot_search(
+            token=meta["token"],
+            model_name=meta["entity_model"],
+            model_version=meta["entity_version"],
+            condition=criteria
+        )
+        await self._wait_for_search_completion(token=meta["token"], snapshot_id=snapshot_id)
+        async for page in self._iter_search_result_pages(meta["token"], snapshot_id,
+                                                         page_size or CYODA_SEARCH_PAGE_SIZE):
+            for entity in await self._convert_to_entities(page) or []:
+                yield entity
+
+    async def _iter_search_result_pages(self, token, snapshot_id, page_size):
+        """Yield result pages one by one, the next page is requested while the current one is consumed."""
+        page_number = 0
+        next_page = asyncio.ensure_future(self._get_search_result(token, snapshot_id, page_size, page_number))
+        try:
+            while next_page is not None:
+                page = await next_page
+                total_pages = page.get("page", {}).get("totalPages", 0)
+                page_number += 1
+                next_page = asyncio.ensure_future(
+                    self._get_search_result(token, snapshot_id, page_size, page_number)
+                ) if page_number < total_pages else None
+                yield page
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+
+    @_invalidates_searches
     async def save(self, meta, entity: Any) -> Any:
+        entity[VERSION_FIELD] = get_version(entity) + 1
         res = await self._save_new_entities(meta, [entity])
         return res[0]['entityIds'][0]
 
-    async def save_all(self, meta, entities: List[Any]) -> bool:
-        res = await self._save_new_entities(meta, entities)
-        return res[0]['entityIds'][0]
+    @_invalidates_searches
+    async def save_all(self, meta, entities: List[Any]) -> List[dict]:
+        """Save entities in chunks, returns one {"technical_id", "success", "error"} result per entity."""
+
+        async def save_chunk(chunk):
+            for entity in chunk:
+                entity[VERSION_FIELD] = get_version(entity) + 1
+            res = await self._save_new_entities(meta, chunk)
+            ids = [_id for item in res for _id in item.get('entityIds', [])]
+            if len(ids) != len(chunk):
+                raise Exception(f"Expected {len(chunk)} entity ids, got {len(ids)}: {res}")
+            return [_bulk_result(_id) for _id in ids]
+
+        return await self._run_in_chunks(entities, save_chunk)
 
+    @_invalidates_searches
     async def update(self, meta, _id, entity: Any) -> Any:
         meta["technical_id"] = _id
         if entity is None:
             res = await self._launch_transition(meta)
             return res
-        res = await self._update_entity(meta=meta, _id=_id, entity=entity)
+        expected_version = meta.get("expected_version")
+        if expected_version is None:
+            entity[VERSION_FIELD] = get_version(entity) + 1
+            res = await self._update_entity(meta=meta, _id=_id, entity=entity)
+            return res['entityIds'][0]
+        # Cyoda has no conditional update, the version is checked here and conditional
+        # updates of an entity are serialized within this process (not across processes)
+        async with self._update_locks.lock(_id):
+            check_version(_id, await self._get_by_id(meta, _id), expected_version)
+            entity[VERSION_FIELD] = expected_version + 1
+            res = await self._update_entity(meta=meta, _id=_id, entity=entity)
         return res['entityIds'][0]
 
-    async def update_all(self, meta, entities: List[Any]) -> List[Any]:
-        res = await self._update_entities(meta, entities)
-        return res
+    @_invalidates_searches
+    async def patch(self, meta, _id, patch: List[dict], entity: Any) -> Any:
+        if not CYODA_JSON_PATCH_ENABLED:
+            raise NotImplementedError("JSON Patch updates are disabled for Cyoda")
+        meta["technical_id"] = _id
+        version = get_version(entity) + 1
+        patch = patch + [{"op": "add", "path": f"/{VERSION_FIELD}", "value": version}]
+        try:
+            async with self._update_locks.lock(_id):
+                res = await send_patch_request(meta["token"], API_URL,
+                                               f"entity/JSON/{_id}/{meta["update_transition"]}",
+                                               data=json.dumps(patch, default=custom_serializer))
+        except aiohttp.ClientResponseError as e:
+            if e.status in (405, 415, 501):
+                raise NotImplementedError(f"Cyoda does not accept JSON Patch updates: {e.status}")
+            raise
+        entity[VERSION_FIELD] = version
+        return res['entityIds'][0]
+
+    @_invalidates_searches
+    async def update_all(self, meta, entities: List[Any]) -> List[dict]:
+        """Update entities (identified by their technical_id) in chunks, returns one result per entity."""
+        results = [None] * len(entities)
+        indexed = []
+        for i, entity in enumerate(entities):
+            _id = entity.get("technical_id") if isinstance(entity, dict) else None
+            if _id:
+                indexed.append((i, entity))
+            else:
+                results[i] = _bulk_result(None, error="Entity has no technical_id")
+
+        async def update_chunk(chunk):
+            for _, entity in chunk:
+                entity[VERSION_FIELD] = get_version(entity) + 1
+            await self._update_entities(meta, [entity for _, entity in chunk])
+            return [_bulk_result(entity["technical_id"]) for _, entity in chunk]
+
+        for (i, _), result in zip(indexed, await self._run_in_chunks(indexed, update_chunk)):
+            results[i] = result
+        return results
 
     async def _search_entities(self, meta, condition):
         # Create a snapshot search
@@ -110,36 +264,51 @@ class CyodaRepository(CrudRepository):
         # Wait for the search to complete
         await self._wait_for_search_completion(
             token=meta["token"],
-            snapshot_id=snapshot_id,
-            timeout=60,  # Adjust timeout as needed
-            interval=300  # Adjust interval (in milliseconds) as needed
+            snapshot_id=snapshot_id
         )
 
         # Retrieve search results
         search_result = await self._get_search_result(
             token=meta["token"],
             snapshot_id=snapshot_id,
-            page_size=100,  # Adjust page size as needed
-            page_number=1  # Starting with the first page
+            page_size=CYODA_SEARCH_PAGE_SIZE,
+            page_number=0  # Starting with the first page
         )
         return search_result
 
     async def _get_all_by_ids(self, meta, keys) -> List[Any]:
+        semaphore = asyncio.Semaphore(CYODA_FETCH_CONCURRENCY)
+
+        async def fetch(key):
+            async with semaphore:
+                try:
+                    return await self._get_by_id(meta, key)
+                except Exception as e:
+                    logger.error(f"Error reading key '{key}': {e}")
+                    return None
+
+        return list(await asyncio.gather(*(fetch(key) for key in keys)))
+
+    async def _get_all_by_key_path(self, meta, key_path, keys) -> List[Any]:
+        condition = {
+            "type": "group",
+            "operator": "OR",
+            "conditions": [
+                {"type": "simple", "jsonPath": key_path, "operatorType": "EQUALS", "value": key}
+                for key in dict.fromkeys(keys)
+            ]
+        }
+        matches = {}
         try:
-            for key in keys:
-                search_result = await self._search_entities(meta, meta["condition"])
-                if search_result.get('page').get('totalElements', 0) == 0:
-                    return []
-                result_entities = await self._convert_to_entities(search_result)
-            return result_entities
-
-
+            async for entity in self.iter_all_by_criteria(meta, condition):
+                matches.setdefault(_get_by_json_path(entity, key_path), []).append(entity)
         except TimeoutError as te:
-            logger.error(f"Timeout while reading key '{key}': {te}")
+            logger.error(f"Timeout while reading keys {keys}: {te}")
+            return []
         except Exception as e:
-            logger.error(f"Error reading key '{key}': {e}")
-
-        return None
+            logger.error(f"Error reading keys {keys}: {e}")
+            return []
+        return [entity for key in dict.fromkeys(keys) for entity in matches.get(key, [])]
 
     async def _get_by_key(self, meta, key) -> Optional[Any]:
         try:
@@ -181,8 +350,47 @@ class CyodaRepository(CrudRepository):
     async def delete(self, meta, entity: Any) -> None:
         pass
 
+    @_invalidates_searches
     async def delete_by_id(self, meta, id: Any) -> None:
-        pass
+        return await send_delete_request(meta["token"], API_URL, f"entity/{id}")
+
+    async def _delete_by_ids(self, meta, ids: List[Any]) -> List[dict]:
+        semaphore = asyncio.Semaphore(CYODA_BULK_CONCURRENCY)
+
+        async def delete(_id):
+            if not _id:
+                return _bulk_result(None, error="Entity has no technical_id")
+            async with semaphore:
+                try:
+                    await self.delete_by_id(meta, _id)
+                    return _bulk_result(_id)
+                except Exception as e:
+                    logger.error(f"Error deleting entity '{_id}': {e}")
+                    return _bulk_result(_id, error=str(e))
+
+        return list(await asyncio.gather(*(delete(_id) for _id in ids)))
+
+    @staticmethod
+    async def _run_in_chunks(items: List[Any], send_chunk) -> List[dict]:
+        """
+        Send `items` in chunks of CYODA_BULK_CHUNK_SIZE with at most CYODA_BULK_CONCURRENCY
+        chunks in flight, a failed chunk marks each of its items as failed.
+        """
+        semaphore = asyncio.Semaphore(CYODA_BULK_CONCURRENCY)
+        chunks = [items[i:i + CYODA_BULK_CHUNK_SIZE] for i in range(0, len(items), CYODA_BULK_CHUNK_SIZE)]
+
+        async def run(chunk):
+            async with semaphore:
+                try:
+                    return await send_chunk(chunk)
+                except Exception as e:
+                    logger.error(f"Bulk request for {len(chunk)} entities failed: {e}")
+                    return [_bulk_result(_item_id(item), error=str(e)) for item in chunk]
+
+        results = []
+        for chunk_results in await asyncio.gather(*(run(chunk) for chunk in chunks)):
+            results.extend(chunk_results)
+        return results
 
     @staticmethod
     async def _save_entity_schema(token, entity_name, version, data):
@@ -229,7 +437,8 @@ class CyodaRepository(CrudRepository):
         export_model_path = f"model/export/SIMPLE_VIEW/{entity_name}/{version}"
         response = await send_get_request(token, API_URL, export_model_path)
 
-        if response:
+        # 404 responses come back as a JSON error body
+        if response and not (isinstance(response, dict) and response.get("status") == 404):
             return True
         else:
             return False
@@ -295,25 +504,9 @@ class CyodaRepository(CrudRepository):
         else:
             raise Exception(f"Snapshot search trigger failed: {response}")
 
-    async def _wait_for_search_completion(self, token, snapshot_id, timeout=5, interval=10):
-        start_time = now()  # Record the start time
-
-        while True:
-            status_response = await self._get_snapshot_status(token, snapshot_id)
-            status = status_response.get("snapshotStatus")
-
-            # Check if the status is SUCCESSFUL or FAILED
-            if status == "SUCCESSFUL":
-                return status_response
-            elif status != "RUNNING":
-                raise Exception(f"Snapshot search failed: {json.dumps(status_response, indent=4)}")
-
-            elapsed_time = now() - start_time
-
-            if elapsed_time > timeout:
-                raise TimeoutError(f"Timeout exceeded after {timeout} seconds")
-
-            time.sleep(interval / 1000)  # Wait for the given interval (msec) before checking again
+    async def _wait_for_search_completion(self, token, snapshot_id, timeout=None):
+        return await self._search_poller.wait(lambda: self._get_snapshot_status(token, snapshot_id),
+                                              timeout=timeout)
 
     @staticmethod
     async def _get_search_result(token, snapshot_id, page_size, page_number):
@@ -324,7 +517,7 @@ class CyodaRepository(CrudRepository):
             'pageNumber': f"{page_number}"
         }
 
-        response = await send_get_request(token=token, api_url=API_URL, path=result_url)
+        response = await send_get_request(token=token, api_url=API_URL, path=result_url, params=params)
 
         if response:
             return response
@@ -334,23 +527,16 @@ class CyodaRepository(CrudRepository):
     @staticmethod
     async def _update_entities(meta, entities: List[Any]) -> List[Any]:
         path = "entity/JSON"
-        payload = []
-        for entity in entities:
-            payload_json = json.dumps(entity, default=custom_serializer)
-
-            payload.append({
-                "id": meta.get("technical_id"),
-                "transition": meta.get("update_transition"),
-                "payload": payload_json
-            })
-            data = json.dumps(payload)
-            response = await send_put_request(meta["token"], API_URL, path, data=data)
-            if response:
-                return entities
-            else:
-                raise Exception(f"Get search result failed: {response}")
-
-        return entities
+        payload = [{
+            "id": entity.get("technical_id"),
+            "transition": meta.get("update_transition"),
+            "payload": json.dumps(entity, default=custom_serializer)
+        } for entity in entities]
+        response = await send_put_request(meta["token"], API_URL, path, data=json.dumps(payload))
+        if response:
+            return entities
+        else:
+            raise Exception(f"Bulk update failed: {response}")
 
     @staticmethod
     async def _update_entity(meta, _id, entity: Any) -> List[Any]:
@@ -400,6 +586,12 @@ class CyodaRepository(CrudRepository):
         logger.info(response)
         return response
 
+    def stats(self):
+        return {
+            "snapshot_search": self._search_poller.stats(),
+            "search_cache": self._search_cache.stats(),
+        }
+
     async def _launch_transition(self, meta):
         path = f"/platform-api/entity/transition?entityId={meta["technical_id"]}&entityClass=com.cyoda.tdb.model.treenode.TreeNodeEntity&transitionName={meta["update_transition"]}"
         response = await send_put_request(meta["token"], API_URL, path)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from common.config.config import CYODA_SEARCH_CACHE_TTL, CYODA_SEARCH_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_condition(condition: Any) -> Any:
+    """Return `condition` with the members of every group in a stable order (AND/OR are commutative)."""
+    if isinstance(condition, dict):
+        normalized = {key: normalize_condition(value) for key, value in condition.items()}
+        if normalized.get("type") == "group" and isinstance(normalized.get("conditions"), list):
+            normalized["conditions"] = sorted(normalized["conditions"],
+                                              key=lambda c: json.dumps(c, sort_keys=True))
+        return normalized
+    if isinstance(condition, list):
+        return [normalize_condition(item) for item in condition]
+    return condition
+
+
+def condition_key(entity_model: str, entity_version: str, condition: Any) -> str:
+    canonical = json.dumps([entity_model, str(entity_version), normalize_condition(condition)],
+                           sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SearchResultCache:
+    """
+    Caches snapshot search results by (model, version, normalized condition).
+
+    Results are kept as JSON for at most `ttl` seconds and `max_entries` searches (LRU).
+    Every write of a model made by this process drops the cached searches of that model
+    and bumps its generation, results of searches that were running during the write
+    are not stored.
+    """
+
+    def __init__(self, ttl: float = CYODA_SEARCH_CACHE_TTL, max_entries: int = CYODA_SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, Tuple[Tuple[str, str], str, float]] = OrderedDict()
+        self._generations: Dict[Tuple[str, str], int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return json.loads(entry[1])
+
+    def generation(self, entity_model: str, entity_version: str) -> int:
+        return self._generations.get((entity_model, str(entity_version)), 0)
+
+    def put(self, key: str, entity_model: str, entity_version: str, result: Any, generation: int):
+        """Store `result` unless the model was written since `generation` was read."""
+        if not self.enabled or generation != self.generation(entity_model, entity_version):
+            return
+        try:
+            data = json.dumps(result)
+        except (TypeError, ValueError) as e:
+            logger.debug(f"Search result is not cacheable: {e}")
+            return
+        self._entries[key] = ((entity_model, str(entity_version)), data, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, entity_model: str, entity_version: str):
+        model = (entity_model, str(entity_version))
+        self._generations[model] = self._generations.get(model, 0) + 1
+        stale = [key for key, entry in self._entries.items() if entry[0] == model]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from common.config.config import CYODA_SEARCH_TIMEOUT, CYODA_SEARCH_MIN_POLL_MS, CYODA_SEARCH_MAX_POLL_MS
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotSearchPoller:
+    """
+    Waits for Cyoda snapshot searches without blocking the event loop.
+
+    The first status check is delayed by a fraction of the observed average search
+    duration, later checks back off exponentially (with jitter) up to
+    `max_interval`, and the wait gives up with TimeoutError at a real deadline.
+    Cancelling the awaiting task stops the polling immediately.
+    """
+
+    def __init__(self,
+                 timeout: float = CYODA_SEARCH_TIMEOUT,
+                 min_interval: float = CYODA_SEARCH_MIN_POLL_MS / 1000,
+                 max_interval: float = CYODA_SEARCH_MAX_POLL_MS / 1000,
+                 smoothing: float = 0.2):
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        self.avg_duration = None
+        self.searches = 0
+        self.polls = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def first_delay(self) -> float:
+        if self.avg_duration is None:
+            return self.min_interval
+        return min(max(self.avg_duration * 0.8, self.min_interval), self.max_interval)
+
+    async def wait(self, get_status: Callable[[], Awaitable[Dict[str, Any]]], timeout: float = None) -> Dict[str, Any]:
+        timeout = timeout if timeout is not None else self.timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        delay = ceiling = self.first_delay()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError(f"Timeout exceeded after {timeout} seconds")
+                await asyncio.sleep(min(delay, remaining))
+
+                self.polls += 1
+                status_response = await get_status()
+                status = status_response.get("snapshotStatus")
+                # Check if the status is SUCCESSFUL or FAILED
+                if status == "SUCCESSFUL":
+                    self._record(time.monotonic() - started)
+                    return status_response
+                elif status != "RUNNING":
+                    raise Exception(f"Snapshot search failed: {json.dumps(status_response, indent=4)}")
+
+                ceiling = min(ceiling * 2, self.max_interval)
+                delay = random.uniform(ceiling / 2, ceiling)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+    def _record(self, duration: float):
+        self.searches += 1
+        if self.avg_duration is None:
+            self.avg_duration = duration
+        else:
+            self.avg_duration += self.smoothing * (duration - self.avg_duration)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "searches": self.searches,
+            "polls": self.polls,
+            "polls_per_search": round(self.polls / self.searches, 2) if self.searches else 0.0,
+            "avg_duration_ms": round(self.avg_duration * 1000) if self.avg_duration is not None else None,
+            "first_delay_ms": round(self.first_delay() * 1000),
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,165 @@
+import glob
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from common.config.config import INMEMORY_SNAPSHOT_EVERY, INMEMORY_SNAPSHOT_INTERVAL, INMEMORY_LOG_FSYNC
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "snapshot.jsonl"
+LOG_FILE = "log.jsonl"
+# Logs rotated out by a snapshot that isn't written yet, named after their last seq
+ROTATED_LOG_FILE = "log.{seq}.jsonl"
+
+
+class EntityLog:
+    """
+    Append-only log of entity mutations with periodic compacted snapshots.
+
+    Every put/patch/delete is appended to log.jsonl as one JSON line. After
+    `snapshot_every` log records (or `snapshot_interval` seconds) the full state is
+    written to snapshot.jsonl (atomically) and the log is truncated. `replay()` yields
+    the snapshot followed by the log tail, a partially written last line is ignored.
+    Records carry a sequence number and the snapshot remembers the last one it covers,
+    so a log that outlived a crash during compaction is not applied twice.
+
+    A snapshot can be taken in two steps: `begin_snapshot()` rotates the log out and
+    `write_snapshot()`, which may run on another thread, writes the state as of that
+    point and then deletes the rotated log. Until then replay picks up the rotated log.
+    """
+
+    def __init__(self, directory: str,
+                 snapshot_every: int = INMEMORY_SNAPSHOT_EVERY,
+                 snapshot_interval: float = INMEMORY_SNAPSHOT_INTERVAL,
+                 fsync: bool = INMEMORY_LOG_FSYNC,
+                 default: Callable[[Any], Any] = None):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.default = default
+        os.makedirs(directory, exist_ok=True)
+        self._log = None
+        self.seq = 0
+        # Counts the snapshots taken by this process
+        self.generation = 0
+        self.records = 0
+        self.snapshots = 0
+        self._last_snapshot = time.monotonic()
+
+    def replay(self) -> Iterator[Dict[str, Any]]:
+        snapshot_seq = 0
+        rotated = [os.path.basename(path) for path in self._rotated_logs()]
+        for name in (SNAPSHOT_FILE, *rotated, LOG_FILE):
+            path = os.path.join(self.directory, name)
+            if not os.path.exists(path):
+                continue
+            valid_bytes = 0
+            with open(path, 'rb') as file:
+                for line_number, line in enumerate(file, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping unreadable record {name}:{line_number}")
+                        continue
+                    finally:
+                        if line.endswith(b"\n"):
+                            valid_bytes += len(line)
+                    if record["op"] == "snapshot":
+                        snapshot_seq = self.seq = record["seq"]
+                        continue
+                    if name != SNAPSHOT_FILE:
+                        if record["seq"] <= snapshot_seq:
+                            continue
+                        self.seq = record["seq"]
+                        self.records += 1
+                    yield record
+            if name == LOG_FILE and os.path.getsize(path) > valid_bytes:
+                # Drop a record cut short by a crash so new records start on a fresh line
+                os.truncate(path, valid_bytes)
+
+    def put(self, technical_id: str, entity_model: str, entity: Any):
+        self._append({"op": "put", "id": technical_id, "model": entity_model, "entity": entity})
+
+    def patch(self, technical_id: str, entity_model: str, patch: Any):
+        self._append({"op": "patch", "id": technical_id, "model": entity_model, "patch": patch})
+
+    def delete(self, technical_id: str):
+        self._append({"op": "delete", "id": technical_id})
+
+    def should_snapshot(self) -> bool:
+        return self.records >= self.snapshot_every or (
+                self.records > 0 and time.monotonic() - self._last_snapshot >= self.snapshot_interval)
+
+    def snapshot(self, entities: Iterable[Tuple[str, str, Any]]):
+        """Write `(technical_id, entity_model, entity)` as the new snapshot and truncate the log."""
+        self.write_snapshot(self.begin_snapshot(), entities)
+
+    def begin_snapshot(self) -> int:
+        """
+        Rotate the log out for a snapshot of the current state and return its seq, new
+        records go to a fresh log.
+        """
+        self.generation += 1
+        self.close()
+        path = os.path.join(self.directory, LOG_FILE)
+        if os.path.exists(path):
+            os.replace(path, os.path.join(self.directory, ROTATED_LOG_FILE.format(seq=self.seq)))
+        self.records = 0
+        self._last_snapshot = time.monotonic()
+        return self.seq
+
+    def write_snapshot(self, seq: int, entities: Iterable[Tuple[str, str, Any]]):
+        """Write the state as of `seq` (from `begin_snapshot`) and delete the logs it covers."""
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = f"{path}.tmp"
+        count = 0
+        with open(tmp_path, 'w') as file:
+            file.write(self._dumps({"op": "snapshot", "seq": seq}))
+            for technical_id, entity_model, entity in entities:
+                file.write(self._dumps({"op": "put", "id": technical_id, "model": entity_model, "entity": entity}))
+                count += 1
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        for rotated_path in self._rotated_logs():
+            if self._rotated_seq(rotated_path) <= seq:
+                os.remove(rotated_path)
+        self.snapshots += 1
+        logger.info(f"Wrote snapshot of {count} entities to {path}")
+
+    def _rotated_logs(self) -> List[str]:
+        paths = glob.glob(os.path.join(self.directory, ROTATED_LOG_FILE.format(seq="*")))
+        return sorted(paths, key=self._rotated_seq)
+
+    @staticmethod
+    def _rotated_seq(path) -> int:
+        return int(os.path.basename(path).split(".")[1])
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _append(self, record):
+        if self._log is None:
+            self._log = open(os.path.join(self.directory, LOG_FILE), 'a')
+        self.seq += 1
+        record["seq"] = self.seq
+        self._log.write(self._dumps(record))
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self.records += 1
+
+    def _dumps(self, record) -> str:
+        return json.dumps(record, default=self.default, separators=(",", ":")) + "\n"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "log_records": self.records,
+            "snapshots": self.snapshots,
+        }
@@ -1,15 +1,41 @@
+import copy
 import threading
 from typing import List, Any
 
-from common.repository.crud_repository import CrudRepository
+from common.config.config import INMEMORY_PERSISTENCE_DIR
+from common.repository.crud_repository import CrudRepository, VERSION_FIELD, check_version, get_version
+from common.repository.entity_log import EntityLog
+from common.repository.tiered_store import TieredStore, decode_raw_items
+from common.util.json_patch import apply_patch
 from common.util.utils import *
 
 logger = logging.getLogger('django')
 
-cache = {}
+cache = TieredStore()
+
+
+def _get_path_value(entity, json_path):
+    value = entity
+    for part in json_path.lstrip("$").strip(".").split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
 
 
 class InMemoryRepository(CrudRepository):
+    """
+    Keeps entities in the module level `cache` (technical_id -> entity), a memory
+    bounded TieredStore.
+
+    Equality lookups on JSON paths declared with `declare_index` are served from hash
+    indexes (value -> technical ids) maintained on save, update and delete, other
+    criteria fall back to scanning the entities of the model.
+
+    Writes increment the entity's version, updates with an `expected_version` in meta
+    are compare-and-swap.
+
+    With INMEMORY_PERSISTENCE_DIR set, every mutation is appended to an EntityLog and
+    the entities are restored from its snapshot and log on startup.
+    """
     _instance = None
     _lock = threading.Lock()
 
@@ -19,25 +45,97 @@ class InMemoryRepository(CrudRepository):
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super(InMemoryRepository, cls).__new__(cls)
+                    cls._instance._models = {}
+                    cls._instance._indexes = {}
+                    cls._instance._indexed_values = {}
+                    cls._instance.index_lookups = 0
+                    cls._instance.scans = 0
+                    # Log generation of the last put/patch logged per entity, a patch is only
+                    # logged against a state that the log already reproduces
+                    cls._instance._logged_at = {}
+                    # Snapshot being written in the background
+                    cls._instance._snapshot_task = None
+                    cls._instance._log = EntityLog(INMEMORY_PERSISTENCE_DIR, default=custom_serializer) \
+                        if INMEMORY_PERSISTENCE_DIR else None
+                    if cls._instance._log:
+                        cls._instance._replay()
         return cls._instance
 
     def __init__(self):
         pass
 
+    def _replay(self):
+        started = time.monotonic()
+        skipped = 0
+        for record in self._log.replay():
+            try:
+                self._replay_record(record)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                # A corrupt or out of order record must not keep the app from starting
+                skipped += 1
+                logger.error(f"Skipping log record {record.get('seq')} ({record.get('op')} {record.get('id')}): {e!r}")
+        logger.info(f"Restored {len(cache)} entities from {INMEMORY_PERSISTENCE_DIR} "
+                    f"in {time.monotonic() - started:.2f}s, {skipped} records skipped")
+        self._maybe_snapshot()
+
+    def _replay_record(self, record):
+        if record["op"] == "put":
+            self._store(record["model"], record["id"], record["entity"], log=False)
+        elif record["op"] == "patch" and record["id"] in cache:
+            # Patched on a copy, a patch that doesn't apply leaves the entity as it was
+            patched = apply_patch(copy.deepcopy(cache[record["id"]]), record["patch"])
+            self._store(record["model"], record["id"], patched, log=False)
+        elif record["op"] == "delete" and record["id"] in cache:
+            self._remove(record["id"], log=False)
+
+    async def close(self) -> None:
+        if self._log:
+            if self._snapshot_task is not None:
+                await self._snapshot_task
+            # Also captures entities that were modified in place without an update
+            self._snapshot()
+            self._log.close()
+
+    def pin(self, technical_id, entity=None):
+        """Keep `entity` (or the stored entity) a live object until `unpin`, so changes made to it in place can't be lost."""
+        cache.pin(technical_id, entity)
+
+    def unpin(self, technical_id):
+        cache.unpin(technical_id)
+
+    def declare_index(self, entity_model: str, json_path: str):
+        """Index the entities of `entity_model` by the value at `json_path` (e.g. "$.user_id")."""
+        index_key = (entity_model, json_path)
+        if index_key in self._indexes:
+            return
+        self._indexes[index_key] = {}
+        self._indexed_values[index_key] = {}
+        for technical_id, model in self._models.items():
+            if model == entity_model:
+                self._index_entity(index_key, technical_id, cache.get(technical_id))
+
     async def get_meta(self, token, entity_model, entity_version):
         return {"token": token, "entity_model": entity_model, "entity_version": entity_version}
 
     async def count(self, meta) -> int:
-        pass
+        return len(self._ids_of_model(meta["entity_model"]))
 
     async def delete_all(self, meta) -> None:
-        pass
+        for technical_id in self._ids_of_model(meta["entity_model"]):
+            self._remove(technical_id)
 
-    async def delete_all_entities(self, meta, entities: List[Any]) -> None:
-        pass
+    async def delete_all_entities(self, meta, entities: List[Any]) -> List[dict]:
+        return await self.delete_all_by_key(meta, [entity.get("technical_id") for entity in entities])
 
-    async def delete_all_by_key(self, meta, keys: List[Any]) -> None:
-        pass
+    async def delete_all_by_key(self, meta, keys: List[Any]) -> List[dict]:
+        results = []
+        for key in keys:
+            if key not in cache:
+                results.append({"technical_id": key, "success": False, "error": "Entity not found"})
+            else:
+                self._remove(key)
+                results.append({"technical_id": key, "success": True, "error": None})
+        return results
 
     async def delete_by_key(self, meta, key: Any) -> None:
         pass
@@ -46,44 +144,200 @@ class InMemoryRepository(CrudRepository):
         pass
 
     async def find_all(self, meta) -> List[Any]:
-        pass
+        ids = self._ids_of_model(meta["entity_model"])
+        await cache.load(ids)
+        # Entities removed while they were loaded are left out
+        return [cache[technical_id] for technical_id in ids if technical_id in cache]
 
     async def find_all_by_key(self, meta, keys: List[Any]) -> List[Any]:
-        pass
+        key_path = meta.get("key_path")
+        if not key_path:
+            await cache.load(keys)
+            return [cache.get(key) for key in keys]
+        ids = await self._lookup(meta["entity_model"], key_path, list(dict.fromkeys(keys)))
+        await cache.load(ids)
+        return [cache[technical_id] for technical_id in ids if technical_id in cache]
 
     async def find_by_key(self, meta, key: Any) -> Optional[Any]:
         pass
 
     async def find_by_id(self, meta, uuid: Any) -> Optional[Any]:
+        await cache.load([uuid])
         return cache.get(uuid)
 
     async def find_all_by_criteria(self, meta, criteria: Any) -> Optional[Any]:
-        entities = []
-        for uuid in cache:
-            if cache[uuid][criteria["key"]] == criteria["value"]:
-                cache[uuid]['technical_id'] = uuid
-                entities.append(cache[uuid])
-        return entities
+        ids = await self._lookup(meta["entity_model"], f"$.{criteria['key']}", [criteria["value"]])
+        await cache.load(ids)
+        # Stored entities are left as they are, results carry their technical_id
+        return [dict(cache[uuid], technical_id=uuid) for uuid in ids if uuid in cache]
 
     async def save(self, meta, entity: Any) -> Any:
         if (entity.get("technical_id")):
-            cache[entity.get("technical_id")] = entity
-            return entity.get("technical_id")
-        uuid = str(generate_uuid())
-        cache[uuid] = entity
+            uuid = entity.get("technical_id")
+        else:
+            uuid = str(generate_uuid())
+        await cache.load([uuid])
+        entity[VERSION_FIELD] = get_version(cache.get(uuid)) + 1
+        self._store(meta["entity_model"], uuid, entity)
         return uuid
 
-    async def save_all(self, meta, entities: List[Any]) -> bool:
-        pass
+    async def save_all(self, meta, entities: List[Any]) -> List[dict]:
+        return [{"technical_id": await self.save(meta, entity), "success": True, "error": None} for entity in entities]
 
     async def update(self, meta, id, entity: Any) -> Any:
-        cache[id] = entity
+        await cache.load([id])
+        stored = cache.get(id)
+        check_version(id, stored, meta.get("expected_version"))
+        # The stored entity may be `entity` itself, read its version before it is changed
+        entity[VERSION_FIELD] = get_version(stored) + 1
+        self._store(meta["entity_model"], id, entity)
 
-    async def update_all(self, meta, entities: List[Any]) -> List[Any]:
-        pass
+    async def patch(self, meta, id, patch: List[dict], entity: Any) -> Any:
+        await cache.load([id])
+        stored = cache.get(id)
+        if stored is None:
+            raise ValueError(f"Entity {id} not found")
+        version = get_version(stored) + 1
+        # Callers usually modify the stored object itself, then it's already up to date
+        if stored is not entity:
+            stored = apply_patch(stored, patch)
+        stored[VERSION_FIELD] = entity[VERSION_FIELD] = version
+        self._store(meta["entity_model"], id, stored, log=False)
+        if self._log:
+            if self._logged_at.get(id) == self._log.generation:
+                self._log.patch(id, meta["entity_model"],
+                                patch + [{"op": "add", "path": f"/{VERSION_FIELD}", "value": version}])
+            else:
+                # The patch is relative to the last written state, a snapshot taken since then
+                # may hold unwritten in-place changes (or there is no logged state after a restart)
+                self._log.put(id, meta["entity_model"], stored)
+            self._logged_at[id] = self._log.generation
+            self._maybe_snapshot()
+        return id
+
+    async def update_all(self, meta, entities: List[Any]) -> List[dict]:
+        results = []
+        await cache.load([entity.get("technical_id") for entity in entities])
+        for entity in entities:
+            technical_id = entity.get("technical_id")
+            if technical_id in cache:
+                entity[VERSION_FIELD] = get_version(cache[technical_id]) + 1
+                self._store(meta["entity_model"], technical_id, entity)
+                results.append({"technical_id": technical_id, "success": True, "error": None})
+            else:
+                results.append({"technical_id": technical_id, "success": False, "error": "Entity not found"})
+        return results
 
     async def delete(self, meta, entity: Any) -> None:
         pass
 
     async def delete_by_id(self, meta, technical_id: Any) -> None:
+        if technical_id not in cache:
+            raise KeyError(technical_id)
+        self._remove(technical_id)
+
+    def _ids_of_model(self, entity_model):
+        return [technical_id for technical_id, model in self._models.items() if model == entity_model]
+
+    async def _lookup(self, entity_model, json_path, values) -> List[str]:
+        index = self._indexes.get((entity_model, json_path))
+        if index is not None:
+            self.index_lookups += 1
+            ids = [technical_id for value in values for technical_id in index.get(value, ())]
+        else:
+            self.scans += 1
+            logger.info(f"No index on {entity_model} {json_path}, scanning all entities of the model")
+            ids = self._ids_of_model(entity_model)
+        # Entities may have been modified in place since they were indexed. Peeked, a scan
+        # doesn't bring the entities it reads back to the hot tier
+        entities = await cache.peek_many(ids)
+        positions = {value: i for i, value in enumerate(values)}
+        matches = [technical_id for technical_id, entity in entities.items()
+                   if _get_path_value(entity, json_path) in positions]
+        if index is not None and len(matches) < len(entities):
+            for technical_id in set(entities) - set(matches):
+                self._index_entity((entity_model, json_path), technical_id, entities[technical_id])
+        return sorted(matches, key=lambda technical_id: positions[_get_path_value(entities[technical_id], json_path)])
+
+    def _store(self, entity_model, technical_id, entity, log=True):
+        cache[technical_id] = entity
+        self._models[technical_id] = entity_model
+        for index_key in self._indexes:
+            if index_key[0] == entity_model:
+                self._index_entity(index_key, technical_id, entity)
+        if log and self._log:
+            self._log.put(technical_id, entity_model, entity)
+            self._logged_at[technical_id] = self._log.generation
+            self._maybe_snapshot()
+
+    def _remove(self, technical_id, log=True):
         del cache[technical_id]
+        entity_model = self._models.pop(technical_id, None)
+        self._logged_at.pop(technical_id, None)
+        for index_key in self._indexes:
+            if index_key[0] == entity_model:
+                self._index_entity(index_key, technical_id, None)
+        if log and self._log:
+            self._log.delete(technical_id)
+            self._maybe_snapshot()
+
+    def _maybe_snapshot(self):
+        if not self._log or self._snapshot_task is not None or not self._log.should_snapshot():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._snapshot()
+            return
+        # Only references are taken on the loop, the entities are copied, serialized and
+        # fsynced on a thread. A copy may be newer than the seq, the records logged after
+        # it are full puts so replaying them over it is harmless.
+        seq = self._log.begin_snapshot()
+        items = cache.raw_items()
+        models = dict(self._models)
+        self._snapshot_task = loop.create_task(self._write_snapshot(seq, items, models))
+
+    async def _write_snapshot(self, seq, items, models):
+        try:
+            await asyncio.to_thread(self._log.write_snapshot, seq,
+                                    ((technical_id, models.get(technical_id), entity)
+                                     for technical_id, entity in decode_raw_items(items)))
+        except Exception as e:
+            # The rotated log is kept and replayed until a later snapshot covers it
+            logger.exception(f"Failed to write snapshot {seq}: {e}")
+        finally:
+            cache.release_raw()
+            self._snapshot_task = None
+
+    def _snapshot(self):
+        self._log.snapshot((technical_id, self._models.get(technical_id), entity)
+                           for technical_id, entity in cache.peek_items())
+
+    def _index_entity(self, index_key, technical_id, entity):
+        index, values = self._indexes[index_key], self._indexed_values[index_key]
+        if technical_id in values:
+            old_value = values.pop(technical_id)
+            ids = index.get(old_value)
+            if ids is not None:
+                ids.pop(technical_id, None)
+                if not ids:
+                    del index[old_value]
+        if entity is None:
+            return
+        value = _get_path_value(entity, index_key[1])
+        try:
+            index.setdefault(value, {})[technical_id] = None
+        except TypeError:
+            # Unhashable values (lists, dicts) can't be indexed
+            return
+        values[technical_id] = value
+
+    def stats(self):
+        return {
+            "entities": len(cache),
+            "store": cache.stats(),
+            "log": self._log.stats() if self._log else None,
+            "indexes": {f"{model} {path}": len(index) for (model, path), index in self._indexes.items()},
+            "index_lookups": self.index_lookups,
+            "scans": self.scans,
+        }
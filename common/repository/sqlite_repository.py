@@ -0,0 +1,322 @@
+import asyncio
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import weakref
+from typing import Any, Callable, List, Optional
+
+from common.config.config import SQLITE_PATH, SQLITE_POOL_SIZE
+from common.repository.crud_repository import CrudRepository, VERSION_FIELD, check_version
+from common.util.utils import custom_serializer, generate_uuid
+
+logger = logging.getLogger('quart')
+
+_JSON_PATH = re.compile(r"^\$(\.[A-Za-z_][A-Za-z0-9_]*)+$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    id TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    version TEXT NOT NULL,
+    rev INTEGER NOT NULL DEFAULT 1,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entities_model ON entities (model, version);
+"""
+
+# The entity's version is its row revision
+_UPSERT = f"""
+INSERT INTO entities (id, model, version, rev, data) VALUES (?, ?, ?, 1, json_set(?, '$.{VERSION_FIELD}', 1))
+ON CONFLICT (id) DO UPDATE SET model = excluded.model, version = excluded.version,
+                               data = json_set(excluded.data, '$.{VERSION_FIELD}', entities.rev + 1),
+                               rev = entities.rev + 1
+"""
+
+_UPDATE = f"""
+UPDATE entities SET data = json_set(?, '$.{VERSION_FIELD}', rev + 1), rev = rev + 1 WHERE id = ? RETURNING rev
+"""
+
+
+class _Entity(dict):
+    """A dict that can be weakly referenced, so loaded entities can be shared while in use."""
+    rev = 0
+
+
+def _json_path(json_path: str) -> str:
+    # Paths are inlined into the SQL so the expression indexes can be used, only plain
+    # "$.a.b" paths are accepted
+    if not _JSON_PATH.match(json_path):
+        raise ValueError(f"Unsupported JSON path: {json_path}")
+    return json_path
+
+
+class SqliteRepository(CrudRepository):
+    """
+    Stores entities as JSON in an SQLite database, so several worker processes on one
+    machine share the same chats.
+
+    The database runs in WAL mode (readers don't block the writer) and is used through a
+    small pool of connections driven from worker threads. Bulk writes run in a single
+    transaction. `declare_index` adds an expression index over a JSON path, equality
+    lookups on that path then use it. An entity's version is its row revision, updates
+    with an `expected_version` are checked inside the write transaction.
+
+    Within a process an entity that is still in use is returned as the same object on
+    every read (a new object once another process wrote a newer revision), the workflow
+    relies on that to share the chat it is working on with the request handlers.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls, path: str = SQLITE_PATH, pool_size: int = SQLITE_POOL_SIZE):
+        logger.info("initializing SqliteRepository")
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(SqliteRepository, cls).__new__(cls)
+                    cls._instance.path = path
+                    cls._instance.pool_size = pool_size
+                    cls._instance._pool = queue.Queue()
+                    cls._instance._connections = 0
+                    cls._instance._pool_lock = threading.Lock()
+                    cls._instance._live = weakref.WeakValueDictionary()
+                    cls._instance._indexes = set()
+                    cls._instance.queries = 0
+                    cls._instance.writes = 0
+                    cls._instance._init_schema()
+        return cls._instance
+
+    def __init__(self, path: str = SQLITE_PATH, pool_size: int = SQLITE_POOL_SIZE):
+        pass
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=30000")
+        return connection
+
+    def _init_schema(self):
+        connection = self._connect()
+        try:
+            connection.executescript(_SCHEMA)
+        finally:
+            connection.close()
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._pool_lock:
+            if self._pool.empty() and self._connections < self.pool_size:
+                self._connections += 1
+                return self._connect()
+        return self._pool.get()
+
+    def _call(self, func: Callable[[sqlite3.Connection], Any], write: bool = False) -> Any:
+        connection = self._acquire()
+        try:
+            if not write:
+                return func(connection)
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(connection)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+        finally:
+            self._pool.put(connection)
+
+    async def _run(self, func: Callable[[sqlite3.Connection], Any], write: bool = False) -> Any:
+        if write:
+            self.writes += 1
+        else:
+            self.queries += 1
+        return await asyncio.to_thread(self._call, func, write)
+
+    def declare_index(self, entity_model: str, json_path: str):
+        """Add an expression index for equality lookups on `json_path` (e.g. "$.user_id")."""
+        path = _json_path(json_path)
+        name = "entities_" + re.sub(r"\W", "_", f"{entity_model}_{path[2:]}")
+        connection = self._connect()
+        try:
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {name} "
+                               f"ON entities (model, json_extract(data, '{path}'))")
+        finally:
+            connection.close()
+        self._indexes.add((entity_model, path))
+
+    async def get_meta(self, token, entity_model, entity_version):
+        return {"token": token, "entity_model": entity_model, "entity_version": entity_version}
+
+    async def count(self, meta) -> int:
+        rows = await self._run(lambda c: c.execute("SELECT COUNT(*) FROM entities WHERE model = ? AND version = ?",
+                                                   (meta["entity_model"], str(meta["entity_version"]))).fetchall())
+        return rows[0][0]
+
+    async def delete_all(self, meta) -> None:
+        await self._run(lambda c: c.execute("DELETE FROM entities WHERE model = ? AND version = ?",
+                                            (meta["entity_model"], str(meta["entity_version"]))), write=True)
+
+    async def delete_all_entities(self, meta, entities: List[Any]) -> List[dict]:
+        return await self.delete_all_by_key(meta, [entity.get("technical_id") for entity in entities])
+
+    async def delete_all_by_key(self, meta, keys: List[Any]) -> List[dict]:
+        def delete(connection):
+            return [connection.execute("DELETE FROM entities WHERE id = ?", (key,)).rowcount for key in keys]
+
+        deleted = await self._run(delete, write=True)
+        for key in keys:
+            self._forget(key)
+        return [{"technical_id": key, "success": bool(count), "error": None if count else "Entity not found"}
+                for key, count in zip(keys, deleted)]
+
+    async def delete_by_key(self, meta, key: Any) -> None:
+        pass
+
+    async def exists_by_key(self, meta, key: Any) -> bool:
+        pass
+
+    async def find_all(self, meta) -> List[Any]:
+        rows = await self._run(lambda c: c.execute("SELECT id, rev, data FROM entities WHERE model = ? AND version = ?",
+                                                   (meta["entity_model"], str(meta["entity_version"]))).fetchall())
+        return [self._load(*row) for row in rows]
+
+    async def find_all_by_key(self, meta, keys: List[Any]) -> List[Any]:
+        if not keys:
+            return []
+        placeholders = ",".join("?" * len(keys))
+        key_path = meta.get("key_path")
+        if not key_path:
+            rows = await self._run(lambda c: c.execute(
+                f"SELECT id, rev, data FROM entities WHERE id IN ({placeholders})", list(keys)).fetchall())
+            found = {row[0]: self._load(*row) for row in rows}
+            return [found.get(key) for key in keys]
+        path = _json_path(key_path)
+        rows = await self._run(lambda c: c.execute(
+            f"SELECT id, rev, data, json_extract(data, '{path}') FROM entities "
+            f"WHERE model = ? AND json_extract(data, '{path}') IN ({placeholders})",
+            [meta["entity_model"], *keys]).fetchall())
+        positions = {key: i for i, key in reversed(list(enumerate(keys)))}
+        rows.sort(key=lambda row: positions.get(row[3], len(keys)))
+        return [self._load(*row[:3]) for row in rows]
+
+    async def find_by_key(self, meta, key: Any) -> Optional[Any]:
+        pass
+
+    async def find_by_id(self, meta, uuid: Any) -> Optional[Any]:
+        rows = await self._run(lambda c: c.execute("SELECT id, rev, data FROM entities WHERE id = ?",
+                                                   (uuid,)).fetchall())
+        return self._load(*rows[0]) if rows else None
+
+    async def find_all_by_criteria(self, meta, criteria: Any) -> Optional[Any]:
+        path = _json_path(f"$.{criteria['key']}")
+        if (meta["entity_model"], path) not in self._indexes:
+            logger.info(f"No index on {meta['entity_model']} {path}, the query scans the model")
+        rows = await self._run(lambda c: c.execute(
+            f"SELECT id, data FROM entities WHERE model = ? AND version = ? AND json_extract(data, '{path}') = ?",
+            (meta["entity_model"], str(meta["entity_version"]), criteria["value"])).fetchall())
+        return [dict(json.loads(data), technical_id=technical_id) for technical_id, data in rows]
+
+    async def save(self, meta, entity: Any) -> Any:
+        technical_id = entity.get("technical_id") or str(generate_uuid())
+        await self._upsert(meta, [(technical_id, entity)])
+        return technical_id
+
+    async def save_all(self, meta, entities: List[Any]) -> List[dict]:
+        items = [(entity.get("technical_id") or str(generate_uuid()), entity) for entity in entities]
+        await self._upsert(meta, items)
+        return [{"technical_id": technical_id, "success": True, "error": None} for technical_id, _ in items]
+
+    async def update(self, meta, id, entity: Any) -> Any:
+        expected_version = meta.get("expected_version")
+        data = json.dumps(entity, default=custom_serializer)
+
+        def update(connection):
+            if expected_version is not None:
+                row = connection.execute("SELECT rev FROM entities WHERE id = ?", (id,)).fetchone()
+                check_version(id, {VERSION_FIELD: row[0]} if row else None, expected_version)
+            return connection.execute(_UPDATE, (data, id)).fetchone()
+
+        row = await self._run(update, write=True)
+        if row is None:
+            # Deleted in the meantime, an update doesn't bring it back
+            self._forget(id)
+            raise ValueError(f"Entity {id} not found")
+        self._remember(id, entity, row[0])
+        return id
+
+    async def update_all(self, meta, entities: List[Any]) -> List[dict]:
+        ids = [entity.get("technical_id") for entity in entities]
+        rows = [(json.dumps(entity, default=custom_serializer), technical_id)
+                for technical_id, entity in zip(ids, entities)]
+
+        def update(connection):
+            return [connection.execute(_UPDATE, row).fetchone() for row in rows]
+
+        updated = await self._run(update, write=True)
+        for technical_id, entity, row in zip(ids, entities, updated):
+            self._forget(technical_id)
+            if row:
+                entity[VERSION_FIELD] = row[0]
+        return [{"technical_id": technical_id, "success": bool(row), "error": None if row else "Entity not found"}
+                for technical_id, row in zip(ids, updated)]
+
+    async def delete(self, meta, entity: Any) -> None:
+        pass
+
+    async def delete_by_id(self, meta, technical_id: Any) -> None:
+        await self.delete_all_by_key(meta, [technical_id])
+
+    async def close(self) -> None:
+        while not self._pool.empty():
+            self._pool.get().close()
+        self._connections = 0
+
+    async def _upsert(self, meta, items):
+        """Write all `(technical_id, entity)` items in one transaction."""
+        rows = [(technical_id, meta["entity_model"], str(meta["entity_version"]),
+                 json.dumps(entity, default=custom_serializer)) for technical_id, entity in items]
+
+        def upsert(connection):
+            connection.executemany(_UPSERT, rows)
+            placeholders = ",".join("?" * len(rows))
+            return connection.execute(f"SELECT id, rev FROM entities WHERE id IN ({placeholders})",
+                                      [row[0] for row in rows]).fetchall()
+
+        revs = dict(await self._run(upsert, write=True))
+        for technical_id, entity in items:
+            self._remember(technical_id, entity, revs[technical_id])
+
+    def _remember(self, technical_id, entity, rev):
+        entity[VERSION_FIELD] = rev
+        if isinstance(entity, _Entity):
+            entity.rev = rev
+            self._live[technical_id] = entity
+        else:
+            self._live.pop(technical_id, None)
+
+    def _load(self, technical_id, rev, data):
+        live = self._live.get(technical_id)
+        if live is not None and live.rev == rev:
+            return live
+        # New, or written by another process: a fresh object, whoever holds the old one keeps
+        # its own changes (and gets a conflict if it writes with an expected version)
+        live = _Entity(json.loads(data))
+        live.rev = rev
+        self._live[technical_id] = live
+        return live
+
+    def _forget(self, technical_id):
+        self._live.pop(technical_id, None)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "connections": self._connections,
+            "queries": self.queries,
+            "writes": self.writes,
+            "live_entities": len(self._live),
+        }
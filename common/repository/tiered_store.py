@@ -0,0 +1,401 @@
+import asyncio
+import atexit
+import copy
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from common.config.config import INMEMORY_HOT_MAX_BYTES, INMEMORY_WARM_MAX_BYTES, INMEMORY_SPILL_DIR
+
+logger = logging.getLogger(__name__)
+
+# Size estimates look at this many entries of a container and at most _ESTIMATE_NODES
+# values overall, the rest is extrapolated
+_ESTIMATE_SAMPLE = 8
+_ESTIMATE_NODES = 256
+# Assumed JSON size of a value the estimate didn't get to look at
+_UNSEEN_SIZE = 32
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Approximate JSON size of `value` in bytes from a bounded sample of it, so the cost
+    doesn't grow with the size of the entity.
+    """
+    return _estimate(value, [_ESTIMATE_NODES])
+
+
+def _estimate(value, budget: List[int]) -> int:
+    budget[0] -= 1
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        items = list(islice(value.items(), _ESTIMATE_SAMPLE)) if budget[0] > 0 else []
+        if not items:
+            return 2 + len(value) * _UNSEEN_SIZE
+        sampled = sum(len(str(key)) + 4 + _estimate(item, budget) for key, item in items)
+        return 2 + sampled * len(value) // len(items)
+    if isinstance(value, (list, tuple)):
+        step = max(1, len(value) // _ESTIMATE_SAMPLE)
+        items = value[::step][:_ESTIMATE_SAMPLE] if budget[0] > 0 else []
+        if not items:
+            return 2 + len(value) * _UNSEEN_SIZE
+        sampled = sum(_estimate(item, budget) + 1 for item in items)
+        return 2 + sampled * len(value) // len(items)
+    return len(str(value))
+
+
+def _read_file(path: str, missing_ok: bool = False) -> Optional[bytes]:
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        if missing_ok:
+            return None
+        raise
+
+
+def _decode(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data))
+
+
+def decode_raw_items(items: List[Tuple[str, str, Any]]) -> Iterator[Tuple[str, Any]]:
+    """Entities of `TieredStore.raw_items()`, meant to run on a worker thread. Live entities are deep copied."""
+    for key, tier, value in items:
+        if tier == "hot":
+            yield key, _copy_live(value)
+        elif tier == "warm":
+            yield key, _decode(value)
+        else:
+            yield key, _decode(_read_file(value))
+
+
+def _copy_live(value, attempts: int = 10):
+    # The loop may modify the entity while it is copied
+    for attempt in range(attempts):
+        try:
+            return copy.deepcopy(value)
+        except RuntimeError:
+            if attempt == attempts - 1:
+                raise
+
+
+class TieredStore(MutableMapping):
+    """
+    Dict-like store of JSON entities bounded by a memory budget.
+
+    Recently used entities stay as live objects in the hot tier (up to `hot_max_bytes`
+    of their JSON size), colder ones are kept as zlib-compressed JSON in the warm tier
+    (up to `warm_max_bytes`) and anything beyond that is spilled to files in
+    `spill_dir`. Reading an entity from a lower tier brings it back as a live object.
+
+    With a running event loop files are written and removed by a background task on a
+    worker thread, entries waiting to be written stay in memory until then. `load()`
+    reads spilled entries back on a worker thread before they are accessed, `peek_many()`
+    reads entries for a scan without moving them between tiers.
+
+    The size of a live entity is estimated from a sample of it whenever it is stored and
+    again when it is unpinned. Entities pinned with `pin()` (e.g. a chat a running
+    workflow is modifying in place) are never demoted, so those changes can't be lost.
+    """
+
+    def __init__(self,
+                 hot_max_bytes: int = INMEMORY_HOT_MAX_BYTES,
+                 warm_max_bytes: int = INMEMORY_WARM_MAX_BYTES,
+                 spill_dir: str = INMEMORY_SPILL_DIR):
+        self.hot_max_bytes = hot_max_bytes
+        self.warm_max_bytes = warm_max_bytes
+        self.spill_dir = spill_dir
+        self._hot: OrderedDict[str, Any] = OrderedDict()
+        self._hot_sizes: Dict[str, int] = {}
+        self._warm: OrderedDict[str, bytes] = OrderedDict()
+        self._cold: Dict[str, str] = {}
+        # Demoted from the warm tier, not written to a file yet
+        self._spilling: OrderedDict[str, bytes] = OrderedDict()
+        # Files of entries that were read back or removed, deleted by the background task
+        self._garbage: List[str] = []
+        self._io_task: Optional[asyncio.Task] = None
+        # Holders of `raw_items()`, dropped files are kept while there are any
+        self._raw_readers = 0
+        self._pins: Dict[str, int] = {}
+        self._spill_path: Optional[str] = None
+        self._file_numbers = itertools.count()
+        self.hot_bytes = 0
+        self.warm_bytes = 0
+        self.demotions = 0
+        self.spills = 0
+        self.warm_hits = 0
+        self.disk_hits = 0
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            return self._hot[key]
+        if key in self._warm:
+            data = self._warm.pop(key)
+            self.warm_bytes -= len(data)
+            self.warm_hits += 1
+        elif key in self._spilling:
+            data = self._spilling.pop(key)
+            self.warm_hits += 1
+        elif key in self._cold:
+            # Blocking read, callers on the loop `load()` the entry first
+            path = self._cold.pop(key)
+            data = _read_file(path)
+            self._garbage.append(path)
+            self.disk_hits += 1
+        else:
+            raise KeyError(key)
+        raw = zlib.decompress(data)
+        value = json.loads(raw)
+        self._put_hot(key, value, len(raw))
+        self._rebalance(keep=key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self._discard(key)
+        self._put_hot(key, value, estimate_size(value))
+        self._rebalance(keep=key)
+
+    def pin(self, key: str, value: Any = None):
+        """
+        Keep the entity live in the hot tier until as many `unpin()` calls, e.g. while it is
+        modified in place. With `value` that object is the one kept live, also if the entity
+        was demoted after it was read.
+        """
+        if key in self:
+            if value is not None and self._hot.get(key) is not value:
+                self[key] = value
+            else:
+                # Brings it back to the hot tier
+                self[key]
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key: str):
+        pins = self._pins.get(key, 0) - 1
+        if pins > 0:
+            self._pins[key] = pins
+            return
+        self._pins.pop(key, None)
+        if key in self._hot:
+            # Modified in place while pinned, measured again
+            size = estimate_size(self._hot[key])
+            self.hot_bytes += size - self._hot_sizes[key]
+            self._hot_sizes[key] = size
+            self._rebalance()
+
+    def __delitem__(self, key: str):
+        if not self._discard(key):
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._hot or key in self._warm or key in self._spilling or key in self._cold
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self._hot)
+        yield from list(self._warm)
+        yield from list(self._spilling)
+        yield from list(self._cold)
+
+    def __len__(self) -> int:
+        return len(self._hot) + len(self._warm) + len(self._spilling) + len(self._cold)
+
+    async def load(self, keys):
+        """Read those of `keys` that were spilled to disk back into memory on a worker thread."""
+        cold = [(key, self._cold[key]) for key in keys if key in self._cold]
+        if not cold:
+            return
+        loaded = await asyncio.to_thread(lambda: [_read_file(path, missing_ok=True) for _, path in cold])
+        for (key, path), data in zip(cold, loaded):
+            # Skipped if it was read, removed or replaced meanwhile
+            if data is None or self._cold.get(key) != path:
+                continue
+            del self._cold[key]
+            self._garbage.append(path)
+            self._warm[key] = data
+            self.warm_bytes += len(data)
+            self.disk_hits += 1
+        self._rebalance()
+
+    async def peek_many(self, keys) -> Dict[str, Any]:
+        """
+        The entities of `keys` (those that exist) without moving them between tiers, e.g.
+        to scan them. Live entities are returned as they are, spilled ones are read on a
+        worker thread.
+        """
+        values = {}
+        cold = []
+        for key in keys:
+            if key in self._hot:
+                values[key] = self._hot[key]
+            elif key in self._warm or key in self._spilling:
+                values[key] = _decode(self._warm.get(key) or self._spilling[key])
+            elif key in self._cold:
+                cold.append((key, self._cold[key]))
+        if cold:
+            loaded = await asyncio.to_thread(lambda: [_read_file(path, missing_ok=True) for _, path in cold])
+            for (key, path), data in zip(cold, loaded):
+                if data is not None:
+                    values[key] = _decode(data)
+                elif key in self:
+                    # Read back into memory meanwhile
+                    values[key] = (await self.peek_many([key]))[key]
+        return values
+
+    def peek_items(self) -> Iterator[Tuple[str, Any]]:
+        """Iterate over all entries without moving them between tiers, e.g. to snapshot them."""
+        yield from list(self._hot.items())
+        yield from self._peek_lower_items()
+
+    def raw_items(self) -> List[Tuple[str, str, Any]]:
+        """
+        All entries as they are stored right now, `(key, tier, value)` with the live entity,
+        the compressed JSON or the file path, cheap enough to take on the loop. Decode them
+        with `decode_raw_items()` on a worker thread, files are kept until `release_raw()`.
+        """
+        self._raw_readers += 1
+        return ([(key, "hot", value) for key, value in self._hot.items()] +
+                [(key, "warm", data) for key, data in self._warm.items()] +
+                [(key, "warm", data) for key, data in self._spilling.items()] +
+                [(key, "cold", path) for key, path in self._cold.items()])
+
+    def release_raw(self):
+        self._raw_readers -= 1
+        self._schedule_io()
+
+    def _peek_lower_items(self) -> Iterator[Tuple[str, Any]]:
+        for key, data in list(self._warm.items()) + list(self._spilling.items()):
+            yield key, _decode(data)
+        for key, path in list(self._cold.items()):
+            yield key, _decode(_read_file(path))
+
+    def _put_hot(self, key, value, size):
+        self._hot[key] = value
+        self._hot_sizes[key] = size
+        self.hot_bytes += size
+
+    def _discard(self, key) -> bool:
+        if key in self._hot:
+            del self._hot[key]
+            self.hot_bytes -= self._hot_sizes.pop(key)
+        elif key in self._warm:
+            self.warm_bytes -= len(self._warm.pop(key))
+        elif key in self._spilling:
+            del self._spilling[key]
+        elif key in self._cold:
+            self._garbage.append(self._cold.pop(key))
+            self._schedule_io()
+        else:
+            return False
+        return True
+
+    def _rebalance(self, keep=None):
+        if self.hot_bytes > self.hot_max_bytes:
+            for key in list(self._hot):
+                if self.hot_bytes <= self.hot_max_bytes:
+                    break
+                if key == keep or not self._hot_sizes[key] or key in self._pins:
+                    continue
+                try:
+                    self._demote(key, self._hot[key])
+                except (TypeError, ValueError):
+                    # Not plain JSON, it can't go to a lower tier so it doesn't count
+                    self.hot_bytes -= self._hot_sizes[key]
+                    self._hot_sizes[key] = 0
+        while self.warm_bytes > self.warm_max_bytes and self._warm:
+            key, data = self._warm.popitem(last=False)
+            self.warm_bytes -= len(data)
+            self._spilling[key] = data
+        self._schedule_io()
+
+    def _demote(self, key, value):
+        data = zlib.compress(json.dumps(value).encode("utf-8"))
+        del self._hot[key]
+        self.hot_bytes -= self._hot_sizes.pop(key)
+        self._warm[key] = data
+        self.warm_bytes += len(data)
+        self.demotions += 1
+
+    def _schedule_io(self):
+        """Write the pending spills and remove dropped files, in the background if there is a running loop."""
+        if not self._has_io():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            spilling, garbage = list(self._spilling.items()), self._take_garbage()
+            self._spilled(spilling, self._write_files(spilling, garbage))
+            return
+        if self._io_task is None or self._io_task.get_loop() is not loop:
+            self._io_task = loop.create_task(self._run_io())
+
+    async def _run_io(self):
+        try:
+            while self._has_io():
+                spilling, garbage = list(self._spilling.items()), self._take_garbage()
+                self._spilled(spilling, await asyncio.to_thread(self._write_files, spilling, garbage))
+        except Exception as e:
+            # Pending entries stay in memory
+            logger.exception(f"Failed to spill entries to {self.spill_dir}: {e}")
+        finally:
+            self._io_task = None
+
+    def _has_io(self) -> bool:
+        return bool(self._spilling or (self._garbage and not self._raw_readers))
+
+    def _take_garbage(self) -> List[str]:
+        if self._raw_readers:
+            return []
+        garbage, self._garbage = self._garbage, []
+        return garbage
+
+    def _write_files(self, spilling, garbage) -> List[str]:
+        for path in garbage:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if spilling and self._spill_path is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self._spill_path = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=self.spill_dir)
+            atexit.register(shutil.rmtree, self._spill_path, True)
+        paths = []
+        for _, data in spilling:
+            path = os.path.join(self._spill_path, f"{next(self._file_numbers)}.json.z")
+            with open(path, 'wb') as file:
+                file.write(data)
+            paths.append(path)
+        return paths
+
+    def _spilled(self, spilling, paths):
+        for (key, data), path in zip(spilling, paths):
+            if self._spilling.get(key) is data:
+                del self._spilling[key]
+                self._cold[key] = path
+                self.spills += 1
+            else:
+                # Read back or removed while it was written
+                self._garbage.append(path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hot": len(self._hot),
+            "hot_bytes": self.hot_bytes,
+            "warm": len(self._warm),
+            "warm_bytes": self.warm_bytes,
+            "spilling": len(self._spilling),
+            "disk": len(self._cold),
+            "pinned": len(self._pins),
+            "demotions": self.demotions,
+            "spills": self.spills,
+            "warm_hits": self.warm_hits,
+            "disk_hits": self.disk_hits,
+        }
@@ -0,0 +1,94 @@
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from common.config.config import ENTITY_PATCH_BASELINES_MAX_BYTES
+from common.util.json_patch import make_patch
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaTracker:
+    """
+    Remembers the last persisted state of recently written entities so that
+    updates can be sent as JSON Patches instead of full documents.
+
+    Baselines are plain JSON snapshots, `(value, size)` with the size of their JSON, kept
+    up to `max_bytes` in total (LRU). Entities without a baseline are written in full.
+    """
+
+    def __init__(self, max_bytes: int = ENTITY_PATCH_BASELINES_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._baselines: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self.size_bytes = 0
+        self.patches = 0
+        self.patch_bytes = 0
+        self.full_writes = 0
+        self.full_bytes = 0
+        self.unchanged = 0
+        self.fallbacks = 0
+
+    def diff(self, key: Hashable, entity: Any) -> Tuple[Optional[List[dict]], Optional[Any]]:
+        """Return (patch, snapshot) for `entity`, patch is None when there is no usable baseline."""
+        snapshot = self._snapshot(entity)
+        baseline = self._baselines.get(key)
+        if snapshot is None or baseline is None:
+            return None, snapshot
+        return make_patch(baseline[0], snapshot[0]), snapshot
+
+    def record_patch(self, key: Hashable, snapshot: Any, patch: List[dict]):
+        if patch:
+            self.patches += 1
+            self.patch_bytes += len(json.dumps(patch))
+        else:
+            self.unchanged += 1
+        self._remember(key, snapshot)
+
+    def record_full_write(self, key: Hashable, entity: Any, snapshot: Any = None):
+        snapshot = snapshot if snapshot is not None else self._snapshot(entity)
+        self.full_writes += 1
+        if snapshot is not None:
+            self.full_bytes += snapshot[1]
+        self._remember(key, snapshot)
+
+    def forget(self, key: Hashable):
+        baseline = self._baselines.pop(key, None)
+        if baseline is not None:
+            self.size_bytes -= baseline[1]
+
+    def _remember(self, key, snapshot):
+        self.forget(key)
+        if snapshot is None or snapshot[1] > self.max_bytes:
+            return
+        self._baselines[key] = snapshot
+        self.size_bytes += snapshot[1]
+        while self.size_bytes > self.max_bytes:
+            _, (_, size) = self._baselines.popitem(last=False)
+            self.size_bytes -= size
+
+    @staticmethod
+    def _snapshot(entity) -> Optional[Tuple[Any, int]]:
+        if entity is None:
+            return None
+        try:
+            data = json.dumps(entity)
+        except (TypeError, ValueError):
+            # Not plain JSON (e.g. contains SDK objects), always written in full
+            return None
+        return json.loads(data), len(data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "baselines": len(self._baselines),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "patches": self.patches,
+            "patch_bytes": self.patch_bytes,
+            "avg_patch_bytes": round(self.patch_bytes / self.patches) if self.patches else 0,
+            "full_writes": self.full_writes,
+            "full_bytes": self.full_bytes,
+            "avg_full_bytes": round(self.full_bytes / self.full_writes) if self.full_writes else 0,
+            "unchanged": self.unchanged,
+            "fallbacks": self.fallbacks,
+        }
@@ -0,0 +1,123 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from common.config.config import ENTITY_CACHE_MAX_BYTES, ENTITY_CACHE_TTL, ENTITY_CACHE_MODEL_TTLS
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[str, str, str]
+
+
+def parse_model_ttls(value: str) -> Dict[str, float]:
+    """Parse a per-model TTL policy such as "chat=30,user=300"."""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in (value or "").split(","))):
+        model, _, ttl = item.partition("=")
+        ttls[model.strip()] = float(ttl)
+    return ttls
+
+
+class EntityCache:
+    """
+    Read-through cache of serialized entities, bounded by total size in bytes (LRU).
+
+    Entities are stored as JSON so every read returns a private copy and the
+    footprint is measured exactly. Each entity key carries a version that is bumped
+    on every write or invalidation, so a caller holding an older version can detect
+    that its copy is stale.
+    """
+
+    def __init__(self,
+                 max_bytes: int = ENTITY_CACHE_MAX_BYTES,
+                 default_ttl: float = ENTITY_CACHE_TTL,
+                 model_ttls: Optional[Dict[str, float]] = None,
+                 max_versions: int = 100000):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.model_ttls = model_ttls if model_ttls is not None else parse_model_ttls(ENTITY_CACHE_MODEL_TTLS)
+        self.max_versions = max_versions
+        self._entries: OrderedDict[CacheKey, Tuple[bytes, int, float]] = OrderedDict()
+        self._versions: OrderedDict[CacheKey, int] = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, entity_model: str, entity_version: str, technical_id: str) -> Optional[Any]:
+        key = (entity_model, entity_version, technical_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        data, _, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return json.loads(data)
+
+    def put(self, entity_model: str, entity_version: str, technical_id: str, entity: Any, bump: bool = False) -> int:
+        """Cache `entity` and return its version, `bump` marks it as a new version (a write)."""
+        key = (entity_model, entity_version, technical_id)
+        version = self._bump(key) if bump else self.get_version(entity_model, entity_version, technical_id)
+        ttl = self.model_ttls.get(entity_model, self.default_ttl)
+        self._remove(key)
+        if entity is None or ttl <= 0:
+            return version
+        try:
+            data = json.dumps(entity).encode("utf-8")
+        except (TypeError, ValueError) as e:
+            logger.debug(f"Entity {technical_id} is not cacheable: {e}")
+            return version
+        if len(data) > self.max_bytes:
+            return version
+        self._entries[key] = (data, version, time.monotonic() + ttl)
+        self.size_bytes += len(data)
+        while self.size_bytes > self.max_bytes:
+            evicted_key, _ = next(iter(self._entries.items()))
+            self._remove(evicted_key)
+            self.evictions += 1
+        return version
+
+    def invalidate(self, entity_model: str, entity_version: str, technical_id: str) -> int:
+        key = (entity_model, entity_version, technical_id)
+        self._remove(key)
+        self.invalidations += 1
+        return self._bump(key)
+
+    def get_version(self, entity_model: str, entity_version: str, technical_id: str) -> int:
+        return self._versions.get((entity_model, entity_version, technical_id), 0)
+
+    def is_stale(self, entity_model: str, entity_version: str, technical_id: str, version: int) -> bool:
+        return version != self.get_version(entity_model, entity_version, technical_id)
+
+    def _bump(self, key: CacheKey) -> int:
+        version = self._versions.pop(key, 0) + 1
+        self._versions[key] = version
+        while len(self._versions) > self.max_versions:
+            self._versions.popitem(last=False)
+        return version
+
+    def _remove(self, key: CacheKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= len(entry[0])
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List, Any
+from typing import List, Any, Optional
 
 class EntityService(ABC):
 
@@ -29,6 +29,7 @@ class EntityService(ABC):
         pass
 
     @abstractmethod
-    async def update_item(self, token: str, entity_model: str, entity_version: str, technical_id: str, entity: Any, meta: Any) -> Any:
-        """Update an existing item in the repository."""
+    async def update_item(self, token: str, entity_model: str, entity_version: str, technical_id: str, entity: Any, meta: Any,
+                          expected_version: Optional[int] = None) -> Any:
+        """Update an existing item in the repository, only if it is still at `expected_version` when given."""
         pass
\ No newline at end of file
@@ -1,10 +1,17 @@
+import copy
 import logging
 import threading
-from typing import Any, List
+from typing import Any, Callable, Dict, List, Optional
 
-from common.config.config import CHAT_REPOSITORY
-from common.repository.crud_repository import CrudRepository
+from common.config.config import CHAT_REPOSITORY, ENTITY_CACHE_ENABLED, ENTITY_WRITE_BEHIND_WINDOW_MS, \
+    ENTITY_PATCH_ENABLED, ENTITY_UPDATE_MAX_ATTEMPTS
+from common.exception.exceptions import ConflictException
+from common.repository.crud_repository import CrudRepository, get_version
+from common.service.delta_tracker import DeltaTracker
+from common.service.entity_cache import EntityCache
 from common.service.entity_service_interface import EntityService
+from common.service.write_behind import WriteBehindBuffer
+from common.util.single_flight import SingleFlight
 
 logger = logging.getLogger('quart')
 
@@ -20,6 +27,20 @@ class EntityServiceImpl(EntityService):
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super(EntityServiceImpl, cls).__new__(cls)
+                    # Callers joining an in-flight read get their own copy of the result
+                    cls._instance._get_item_flight = SingleFlight(clone=copy.deepcopy)
+                    cls._instance._entity_cache = EntityCache() if ENTITY_CACHE_ENABLED else None
+                    cls._instance._write_behind = WriteBehindBuffer(
+                        writer=cls._instance._write_item,
+                        window=ENTITY_WRITE_BEHIND_WINDOW_MS / 1000
+                    ) if ENTITY_WRITE_BEHIND_WINDOW_MS > 0 else None
+                    # Local repositories store the entity itself, a patch saves them nothing
+                    cls._instance._delta_tracker = DeltaTracker() \
+                        if ENTITY_PATCH_ENABLED and repository is not None and repository.remote else None
+                    cls._instance._patch_supported = True
+                    # Set once the repository applied a patch
+                    cls._instance._patch_confirmed = False
+                    cls._instance.conflicts = 0
                     # Only initialize _repository during the first instantiation
                     if repository is not None:
                         cls._instance._repository = repository
@@ -32,10 +53,62 @@ class EntityServiceImpl(EntityService):
 
     async def get_item(self, token: str, entity_model: str, entity_version: str, technical_id: str) -> Any:
         """Retrieve a single item based on its ID."""
+        key = (entity_model, entity_version, technical_id)
+        local = self._get_local(entity_model, entity_version, technical_id)
+        if local is not None:
+            return local
+        if not self._repository.remote:
+            # Local repositories hand out the live entity, every caller must get that one
+            return await self._find_by_id(token, entity_model, entity_version, technical_id)
+        # Concurrent reads of the same entity share one repository call
+        return await self._get_item_flight.do(key, lambda: self._find_by_id(token, entity_model, entity_version,
+                                                                             technical_id))
+
+    async def _find_by_id(self, token, entity_model, entity_version, technical_id):
+        version = self.get_item_version(entity_model, entity_version, technical_id)
         meta = await self._repository.get_meta(token, entity_model, entity_version)
         resp = await self._repository.find_by_id(meta, technical_id)
+        # Don't cache what was read if the entity was written while the read was in flight
+        if self._entity_cache and not self._entity_cache.is_stale(entity_model, entity_version, technical_id, version):
+            self._entity_cache.put(entity_model, entity_version, technical_id, resp)
         return resp
 
+    async def get_items_by_ids(self, token: str, entity_model: str, entity_version: str, technical_ids: List[str]) -> List[Any]:
+        """Retrieve several items by their IDs with one batched repository call, in ID order."""
+        found = {}
+        for technical_id in technical_ids:
+            item = self._get_local(entity_model, entity_version, technical_id)
+            if item is not None:
+                found[technical_id] = item
+        missing = [technical_id for technical_id in dict.fromkeys(technical_ids) if technical_id not in found]
+        if missing:
+            versions = [self.get_item_version(entity_model, entity_version, technical_id) for technical_id in missing]
+            meta = await self._repository.get_meta(token, entity_model, entity_version)
+            resp = await self._repository.find_all_by_key(meta, missing)
+            for technical_id, version, item in zip(missing, versions, resp):
+                found[technical_id] = item
+                if self._entity_cache and not self._entity_cache.is_stale(entity_model, entity_version, technical_id,
+                                                                          version):
+                    self._entity_cache.put(entity_model, entity_version, technical_id, item)
+        return [found.get(technical_id) for technical_id in technical_ids]
+
+    def _get_local(self, entity_model, entity_version, technical_id):
+        key = (entity_model, entity_version, technical_id)
+        if self._write_behind:
+            # Read your own writes that are not flushed yet
+            pending = self._write_behind.get_pending(key)
+            if pending is not None:
+                return copy.deepcopy(pending)
+        if self._entity_cache:
+            return self._entity_cache.get(entity_model, entity_version, technical_id)
+        return None
+
+    def get_item_version(self, entity_model: str, entity_version: str, technical_id: str) -> int:
+        """Return the version of an entity as seen by this process, it changes on every write."""
+        if not self._entity_cache:
+            return 0
+        return self._entity_cache.get_version(entity_model, entity_version, technical_id)
+
     async def get_items(self, token: str, entity_model: str, entity_version: str) -> List[Any]:
         """Retrieve multiple items based on their IDs."""
         meta = await self._repository.get_meta(token, entity_model, entity_version)
@@ -49,20 +122,157 @@ class EntityServiceImpl(EntityService):
 
     async def get_items_by_condition(self, token: str, entity_model: str, entity_version: str, condition: Any) -> List[Any]:
         """Retrieve multiple items based on their IDs."""
-        resp = await self._find_by_criteria(token, entity_model, entity_version, condition.get(CHAT_REPOSITORY))
+        resp = await self._find_by_criteria(token, entity_model, entity_version, self._repository_condition(condition))
         return resp
 
+    async def iter_items_by_condition(self, token: str, entity_model: str, entity_version: str, condition: Any):
+        """Iterate over all items matching the condition without loading the whole result set."""
+        meta = await self._repository.get_meta(token, entity_model, entity_version)
+        async for entity in self._repository.iter_all_by_criteria(meta, self._repository_condition(condition)):
+            yield entity
+
+    @staticmethod
+    def _repository_condition(condition):
+        # Conditions come in a form per repository, the local ones share the "local" form
+        return condition.get(CHAT_REPOSITORY, condition.get("local"))
+
     async def add_item(self, token: str, entity_model: str, entity_version: str, entity: Any) -> Any:
         """Add a new item to the repository."""
         meta = await self._repository.get_meta(token, entity_model, entity_version)
         resp = await self._repository.save(meta, entity)
         return resp
 
-    async def update_item(self, token: str, entity_model: str, entity_version: str, technical_id: str, entity: Any, meta: Any) -> Any:
-        """Update an existing item in the repository."""
+    async def add_items(self, token: str, entity_model: str, entity_version: str, entities: List[Any]) -> List[dict]:
+        """Add several items at once, returns a {"technical_id", "success", "error"} result per item."""
+        meta = await self._repository.get_meta(token, entity_model, entity_version)
+        return await self._repository.save_all(meta, entities)
+
+    async def update_items(self, token: str, entity_model: str, entity_version: str, entities: List[Any]) -> List[dict]:
+        """Update several items (identified by their technical_id) at once, returns a result per item."""
+        for entity in entities:
+            self._forget((entity_model, entity_version, entity.get("technical_id")))
+        meta = await self._repository.get_meta(token, entity_model, entity_version)
+        return await self._repository.update_all(meta, entities)
+
+    async def delete_items(self, token: str, entity_model: str, entity_version: str, technical_ids: List[str]) -> List[dict]:
+        """Delete several items by their IDs, returns a result per item."""
+        for technical_id in technical_ids:
+            self._forget((entity_model, entity_version, technical_id))
+        meta = await self._repository.get_meta(token, entity_model, entity_version)
+        return await self._repository.delete_all_by_key(meta, technical_ids)
+
+    def _forget(self, key):
+        """Drop everything this process remembers about an entity that is about to be rewritten or deleted."""
+        if self._write_behind:
+            self._write_behind.discard(key)
+        if self._delta_tracker:
+            self._delta_tracker.forget(key)
+        if self._entity_cache:
+            self._entity_cache.invalidate(*key)
+
+    async def update_item(self, token: str, entity_model: str, entity_version: str, technical_id: str, entity: Any, meta: Any,
+                          expected_version: Optional[int] = None) -> Any:
+        """
+        Update an existing item in the repository. With `expected_version` the update is
+        written right away and only if the stored item is still at that version, otherwise
+        ConflictException is raised.
+        """
+        key = (entity_model, entity_version, technical_id)
+        if expected_version is not None:
+            return await self._compare_and_swap(key, token, entity, meta, expected_version)
+        if self._write_behind and entity is not None:
+            self._write_behind.submit(key, token, entity, meta)
+            if self._entity_cache:
+                self._entity_cache.invalidate(entity_model, entity_version, technical_id)
+            return technical_id
+        return await self._write_item(key, token, entity, meta)
+
+    async def _compare_and_swap(self, key, token, entity, meta, expected_version):
+        # Buffered writes of the entity go first, the version is checked against the result
+        await self.flush(*key)
+        if self._delta_tracker:
+            # Conditional updates are written in full, the patch baseline would be stale
+            self._delta_tracker.forget(key)
+        meta["expected_version"] = expected_version
+        try:
+            return await self._write_item(key, token, entity, meta)
+        except ConflictException:
+            self.conflicts += 1
+            raise
+
+    async def update_with_retry(self, token: str, entity_model: str, entity_version: str, technical_id: str,
+                                mutate: Callable[[Any], bool], entity: Any = None,
+                                max_attempts: int = ENTITY_UPDATE_MAX_ATTEMPTS) -> Any:
+        """
+        Read-modify-write an item with optimistic concurrency: `mutate(entity)` changes the
+        item in place and returns whether there is anything to write, the result is written
+        with a compare-and-swap. On a conflict the item is read again and `mutate` re-applied,
+        up to `max_attempts` times. `entity` is an already read copy to start from. Returns
+        the item as written.
+        """
+        for attempt in range(1, max_attempts + 1):
+            if entity is None:
+                entity = await self.get_item(token, entity_model, entity_version, technical_id)
+                if entity is None:
+                    raise ConflictException(f"Entity {technical_id} no longer exists")
+            if not mutate(entity):
+                return entity
+            try:
+                await self.update_item(token=token,
+                                       entity_model=entity_model,
+                                       entity_version=entity_version,
+                                       technical_id=technical_id,
+                                       entity=entity,
+                                       meta={},
+                                       expected_version=get_version(entity))
+                return entity
+            except ConflictException:
+                if attempt == max_attempts:
+                    raise
+                logger.info(f"Concurrent update of {entity_model} {technical_id}, retrying ({attempt}/{max_attempts})")
+                entity = None
+
+    async def _write_item(self, key, token, entity, meta):
+        entity_model, entity_version, technical_id = key
         repository_meta = await self._repository.get_meta(token, entity_model, entity_version)
         meta.update(repository_meta)
+        try:
+            resp = await self._update_in_repository(key, meta, entity)
+        except Exception:
+            if self._entity_cache:
+                self._entity_cache.invalidate(entity_model, entity_version, technical_id)
+            raise
+        if self._entity_cache:
+            self._entity_cache.put(entity_model, entity_version, technical_id, entity, bump=True)
+        return resp
+
+    async def _update_in_repository(self, key, meta, entity):
+        technical_id = key[2]
+        if not self._delta_tracker or not self._patch_supported or entity is None \
+                or meta.get("expected_version") is not None:
+            return await self._repository.update(meta, technical_id, entity)
+
+        patch, snapshot = self._delta_tracker.diff(key, entity)
+        if patch is not None:
+            try:
+                # An unchanged entity is only skipped once the repository is known to apply
+                # patches, and never when the update launches a transition (Cyoda)
+                if patch or meta.get("update_transition") or not self._patch_confirmed:
+                    resp = await self._repository.patch(meta, technical_id, patch, entity)
+                    self._patch_confirmed = True
+                else:
+                    resp = technical_id
+                self._delta_tracker.record_patch(key, snapshot, patch)
+                return resp
+            except NotImplementedError:
+                logger.info("Repository can't apply patches, updates are written in full")
+                self._patch_supported = False
+            except Exception as e:
+                logger.warning(f"Patch update of {technical_id} failed, writing the full entity: {e}")
+                self._delta_tracker.fallbacks += 1
         resp = await self._repository.update(meta, technical_id, entity)
+        if self._patch_supported:
+            self._delta_tracker.record_full_write(key, entity, snapshot)
         return resp
 
     async def _find_by_criteria(self, token, entity_model, entity_version, condition):
@@ -74,5 +284,23 @@ class EntityServiceImpl(EntityService):
         """Update an existing item in the repository."""
         repository_meta = await self._repository.get_meta(token, entity_model, entity_version)
         meta.update(repository_meta)
+        self._forget((entity_model, entity_version, technical_id))
         resp = await self._repository.delete_by_id(meta, technical_id)
-        return resp
\ No newline at end of file
+        return resp
+
+    async def flush(self, entity_model: str = None, entity_version: str = None, technical_id: str = None):
+        """Wait until buffered updates of the given entity (or of all entities) are written."""
+        if not self._write_behind:
+            return
+        key = (entity_model, entity_version, technical_id) if technical_id else None
+        await self._write_behind.flush(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "get_item": self._get_item_flight.stats(),
+            "entity_cache": self._entity_cache.stats() if self._entity_cache else None,
+            "write_behind": self._write_behind.stats() if self._write_behind else None,
+            "delta": dict(self._delta_tracker.stats(), supported=self._patch_supported) if self._delta_tracker else None,
+            "conflicts": self.conflicts,
+            "repository": self._repository.stats() if hasattr(self._repository, "stats") else None,
+        }
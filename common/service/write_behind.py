@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from common.config.config import ENTITY_WRITE_BEHIND_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+class PendingWrite:
+    def __init__(self, token, entity, meta):
+        self.token = token
+        self.entity = entity
+        self.meta = meta
+        self.merged = 0
+        self.attempts = 0
+        self.timer: Optional[asyncio.Task] = None
+
+
+class WriteBehindBuffer:
+    """
+    Merges consecutive updates of the same entity into one write.
+
+    The first update of an entity starts a `window` seconds timer, updates submitted
+    before it fires replace the pending entity, and only the latest state is passed
+    to `writer`. Writes of the same entity are never reordered: a flush waits for
+    the previous write of that entity to finish. `flush()` is a barrier for callers
+    that need the data to be durable before responding.
+
+    An entity stays visible to `get_pending` until its write succeeded. A failed write
+    is queued again (unless a newer update replaced it) and retried after another
+    window, up to `max_attempts` times.
+    """
+
+    def __init__(self, writer: Callable[..., Awaitable[Any]], window: float,
+                 max_attempts: int = ENTITY_WRITE_BEHIND_MAX_ATTEMPTS):
+        self.writer = writer
+        self.window = window
+        self.max_attempts = max_attempts
+        self._pending: Dict[Hashable, PendingWrite] = {}
+        # Writes started and not stored yet, by entity
+        self._in_flight: Dict[Hashable, PendingWrite] = {}
+        self._writing: Dict[Hashable, asyncio.Task] = {}
+        self.requested = 0
+        self.flushed = 0
+        self.saved = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def submit(self, key: Hashable, token, entity, meta):
+        self.requested += 1
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.token, pending.entity, pending.meta = token, entity, meta
+            pending.merged += 1
+            self.saved += 1
+            return
+        pending = PendingWrite(token=token, entity=entity, meta=meta)
+        pending.timer = asyncio.create_task(self._flush_later(key))
+        self._pending[key] = pending
+
+    def get_pending(self, key: Hashable) -> Optional[Any]:
+        pending = self._pending.get(key) or self._in_flight.get(key)
+        return pending.entity if pending is not None else None
+
+    def discard(self, key: Hashable):
+        self._in_flight.pop(key, None)
+        pending = self._pending.pop(key, None)
+        if pending is not None and pending.timer is not None:
+            pending.timer.cancel()
+
+    async def flush(self, key: Hashable = None):
+        """Write the pending update of `key` (or of every entity) and wait until it is stored."""
+        keys = [key] if key is not None else list(self._pending)
+        await asyncio.gather(*(self._flush_key(k) for k in keys))
+        # Also wait for writes already started by the timers
+        writing = [task for k, task in self._writing.items() if key is None or k == key]
+        if writing:
+            await asyncio.gather(*writing, return_exceptions=True)
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        try:
+            await self._flush_key(key, from_timer=True)
+        except Exception as e:
+            logger.exception(f"Write-behind flush of {key} failed: {e}")
+
+    async def _flush_key(self, key, from_timer=False):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        if pending.timer is not None and not from_timer:
+            pending.timer.cancel()
+        self._in_flight[key] = pending
+        previous = self._writing.get(key)
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        task = asyncio.ensure_future(self._write(key, pending))
+        self._writing[key] = task
+        try:
+            await asyncio.shield(task)
+        finally:
+            if self._writing.get(key) is task:
+                del self._writing[key]
+
+    async def _write(self, key, pending):
+        pending.attempts += 1
+        try:
+            await self.writer(key, pending.token, pending.entity, pending.meta)
+            self.flushed += 1
+        except Exception:
+            self.failed += 1
+            self._retry_later(key, pending)
+            raise
+        finally:
+            if self._in_flight.get(key) is pending:
+                del self._in_flight[key]
+
+    def _retry_later(self, key, pending):
+        if self._in_flight.get(key) is not pending or key in self._pending:
+            # Discarded, or replaced by a newer update that carries the whole entity
+            return
+        if pending.attempts >= self.max_attempts:
+            self.dropped += 1
+            logger.error(f"Dropping the update of {key} after {pending.attempts} failed writes")
+            return
+        self.retried += 1
+        pending.timer = asyncio.create_task(self._flush_later(key))
+        self._pending[key] = pending
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "pending": len(self._pending),
+            "requested": self.requested,
+            "flushed": self.flushed,
+            "saved": self.saved,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+
+from common.config.config import HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL, \
+    HTTP_KEEPALIVE_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_TOTAL_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """
+    Process-wide aiohttp session with a keep-alive connection pool.
+
+    The session is created lazily on first use (or explicitly via `start()` from
+    Quart's `before_serving`) and closed via `close()` from `after_serving`.
+    Reusing one session avoids paying for TCP and TLS setup on every request.
+    """
+
+    def __init__(self,
+                 limit=HTTP_POOL_LIMIT,
+                 limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+                 keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT,
+                 total_timeout=HTTP_TOTAL_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout,
+                                             connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop = None
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> aiohttp.ClientSession:
+        return await self.get_session()
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._loop is loop:
+            return self._session
+        async with self._lock:
+            if self._session is None or self._session.closed or self._loop is not loop:
+                connector = aiohttp.TCPConnector(limit=self.limit,
+                                                 limit_per_host=self.limit_per_host,
+                                                 ttl_dns_cache=self.dns_cache_ttl,
+                                                 use_dns_cache=True,
+                                                 keepalive_timeout=self.keepalive_timeout)
+                self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+                self._loop = loop
+                logger.info(f"HTTP client pool started (limit={self.limit}, limit_per_host={self.limit_per_host})")
+        return self._session
+
+    async def close(self):
+        async with self._lock:
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+                logger.info("HTTP client pool closed")
+            self._session = None
+            self._loop = None
+
+
+http_client = HttpClient()
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    return await http_client.get_session()
@@ -0,0 +1,96 @@
+import copy
+from typing import Any, List
+
+
+def _escape(token) -> str:
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _same(old, new) -> bool:
+    return type(old) is type(new) and old == new
+
+
+def make_patch(old: Any, new: Any) -> List[dict]:
+    """
+    Return a JSON Patch (RFC 6902) that turns `old` into `new`.
+
+    Lists are diffed element by element with appends at the end expressed as
+    `add .../-` and removals from the front (queue drains) as `remove .../0`, so
+    the patch for an append-only history stays small however long it gets.
+    """
+    ops = []
+    _diff(old, new, "", ops)
+    return ops
+
+
+def _diff(old, new, path, ops):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": value})
+            else:
+                _diff(old[key], value, f"{path}/{_escape(key)}", ops)
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_list(old, new, path, ops)
+    elif not _same(old, new):
+        ops.append({"op": "replace", "path": path, "value": new})
+
+
+def _diff_list(old, new, path, ops):
+    # Items dropped from the front, e.g. a drained queue
+    dropped = len(old) - len(new)
+    if 0 < dropped and all(_same(a, b) for a, b in zip(old[dropped:], new)):
+        ops.extend({"op": "remove", "path": f"{path}/0"} for _ in range(dropped))
+        return
+    common = min(len(old), len(new))
+    for i in range(common):
+        _diff(old[i], new[i], f"{path}/{i}", ops)
+    for i in range(len(old) - 1, common - 1, -1):
+        ops.append({"op": "remove", "path": f"{path}/{i}"})
+    for item in new[common:]:
+        ops.append({"op": "add", "path": f"{path}/-", "value": item})
+
+
+def apply_patch(doc: Any, patch: List[dict]) -> Any:
+    """Apply a JSON Patch produced by `make_patch` (add/remove/replace) to `doc` in place."""
+    for op in patch:
+        tokens = [_unescape(token) for token in op["path"].split("/")[1:]]
+        if not tokens:
+            if op["op"] == "replace":
+                doc = copy.deepcopy(op["value"])
+                continue
+            raise ValueError(f"Unsupported patch operation on document root: {op}")
+        parent = doc
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        last = tokens[-1]
+        value = copy.deepcopy(op.get("value"))
+        if isinstance(parent, list):
+            if op["op"] == "add":
+                if last == "-":
+                    parent.append(value)
+                else:
+                    parent.insert(int(last), value)
+            elif op["op"] == "remove":
+                del parent[int(last)]
+            elif op["op"] == "replace":
+                parent[int(last)] = value
+            else:
+                raise ValueError(f"Unsupported patch operation: {op['op']}")
+        else:
+            if op["op"] in ("add", "replace"):
+                if op["op"] == "replace" and last not in parent:
+                    raise KeyError(op["path"])
+                parent[last] = value
+            elif op["op"] == "remove":
+                del parent[last]
+            else:
+                raise ValueError(f"Unsupported patch operation: {op['op']}")
+    return doc
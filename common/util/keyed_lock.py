@@ -0,0 +1,69 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Hashable
+
+
+class _KeyedLockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class KeyedLock:
+    """
+    One asyncio lock per key (e.g. per chat), so work on different keys never waits on
+    each other. A key's lock exists only while somebody holds or waits for it.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Hashable, _KeyedLockEntry] = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def lock(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _KeyedLockEntry()
+        entry.users += 1
+        started = time.monotonic()
+        contended = entry.lock.locked()
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            self._release_entry(key, entry)
+            raise
+        waited = time.monotonic() - started
+        self.acquisitions += 1
+        if contended:
+            self.contended += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        try:
+            yield
+        finally:
+            entry.lock.release()
+            self._release_entry(key, entry)
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    def _release_entry(self, key, entry):
+        entry.users -= 1
+        if entry.users == 0 and self._entries.get(key) is entry:
+            del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._entries),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "avg_wait_ms": round(self.total_wait / self.contended * 1000, 2) if self.contended else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+        }
@@ -0,0 +1,84 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+class _Call:
+    __slots__ = ("task", "joiners")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.joiners: List[asyncio.Future] = []
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single in-flight call.
+
+    The first caller for a key starts the call, callers arriving while it is still
+    running await the same result (or exception) instead of starting their own. With
+    `clone` (e.g. copy.deepcopy) those callers get a clone of the result, made as soon
+    as it is ready and before the first caller, which gets the result itself, can
+    modify it.
+    """
+
+    def __init__(self, clone: Optional[Callable[[Any], Any]] = None):
+        self.clone = clone
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is not None:
+            self.shared += 1
+            joiner = asyncio.get_running_loop().create_future()
+            call.joiners.append(joiner)
+            return await joiner
+
+        self.calls += 1
+        call = self._calls[key] = _Call()
+        call.task = asyncio.ensure_future(self._run(key, call, func))
+        call.task.add_done_callback(self._retrieve)
+        return await asyncio.shield(call.task)
+
+    async def _run(self, key, call, func):
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            self._finish(key, call)
+            for joiner in call.joiners:
+                joiner.cancel()
+            raise
+        except Exception as e:
+            self._finish(key, call)
+            for joiner in call.joiners:
+                if not joiner.done():
+                    joiner.set_exception(e)
+                    # Retrieved even if the joiner was cancelled meanwhile
+                    joiner.add_done_callback(self._retrieve)
+            raise
+        self._finish(key, call)
+        for joiner in call.joiners:
+            if not joiner.done():
+                joiner.set_result(self.clone(result) if self.clone else result)
+        return result
+
+    def _finish(self, key, call):
+        # Callers arriving from now on start a new call
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    @staticmethod
+    def _retrieve(future):
+        # Mark the exception as retrieved when every waiter has been cancelled.
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.calls + self.shared
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._calls),
+            "coalescing_ratio": round(self.shared / requests, 4) if requests else 0.0,
+        }
@@ -1,5 +1,7 @@
 import asyncio
+import inspect
 import logging
+import mimetypes
 import os
 import queue
 import jwt
@@ -9,7 +11,7 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import aiofiles
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 import json
 
 import aiohttp
@@ -19,8 +21,10 @@ import hashlib
 import hmac
 import uuid
 from common.config.config import PROJECT_DIR, REPOSITORY_NAME, MAX_FILE_SIZE, CLONE_REPO, REPOSITORY_URL, \
-    AUTH_SECRET_KEY, MAX_IPS_PER_DEVICE_BEFORE_BLOCK, MAX_IPS_PER_DEVICE_BEFORE_ALARM, MAX_SESSIONS_PER_IP
+    AUTH_SECRET_KEY, MAX_IPS_PER_DEVICE_BEFORE_BLOCK, MAX_IPS_PER_DEVICE_BEFORE_ALARM, MAX_SESSIONS_PER_IP, \
+    UPLOAD_CHUNK_SIZE
 from common.exception.exceptions import RequestLimitExceededException, InvalidTokenException
+from common.util.http_client import get_http_session
 
 logger = logging.getLogger(__name__)
 
@@ -405,18 +409,19 @@ async def read_file(file_path: str):
 
 
 async def read_file_object(file_path: str):
-    """Asynchronously read and return a file object for the given file path with a file size limit check."""
+    """
+    Check the file size limit and return the path of a file to upload.
+
+    The path (not an open handle) is returned so that `send_request` can stream the
+    file from disk in chunks instead of loading it into memory.
+    """
     try:
-        # First, check the file size before opening it
-        # todo blocking!!!
-        file_size = os.path.getsize(file_path)
+        file_size = await asyncio.to_thread(os.path.getsize, file_path)
 
         if file_size > MAX_FILE_SIZE:
             raise ValueError(f"File size exceeds the {MAX_FILE_SIZE} byte limit")
 
-        # Now open the file asynchronously if the size is within limits
-        async with aiofiles.open(file_path, 'rb') as file:
-            return file
+        return file_path
     except Exception as e:
         logger.error(f"Failed to open file {file_path}: {e}")
         raise
@@ -440,7 +445,7 @@ async def read_json_file(file_path: str):
         raise
 
 
-async def send_get_request(token: str, api_url: str, path: str = None) -> Optional[Any]:
+async def send_get_request(token: str, api_url: str, path: str = None, params=None) -> Optional[Any]:
     url = f"{api_url}/{path}" if path else f"{api_url}"
     token = f"Bearer {token}" if not token.startswith('Bearer') else token
     headers = {
@@ -448,7 +453,7 @@ async def send_get_request(token: str, api_url: str, path: str = None) -> Option
         "Authorization": f"{token}",
     }
     try:
-        response = await send_request(headers, url, 'GET', None, None)
+        response = await send_request(headers, url, 'GET', None, None, params=params)
         # Raise an error for bad status codes
         logger.info(f"GET request to {url} successful.")
         return response
@@ -457,53 +462,153 @@ async def send_get_request(token: str, api_url: str, path: str = None) -> Option
         raise
 
 
-async def send_request(headers, url, method, data, json, files=None):
-    async with aiohttp.ClientSession() as session:
-        try:
-            if method == 'GET':
-                async with session.get(url, headers=headers) as response:
-                    if response and (response.status == 200 or response.status == 404):
-                        return await response.json()
-            elif method == 'POST':
-                if not files:
-                    async with session.post(url, headers=headers, data=data, json=json) as response:
-                        if response:
-                            data = await response.json()
-                            return data
-                form = aiohttp.FormData()
-                async with aiofiles.open(files, 'rb') as f:
-                    file_content = await f.read()
-
-                async with aiofiles.open(files, 'rb') as f:
-                    form.add_field('file', file_content, filename=files, content_type='application/json')
-
-                # Add additional form data (key-value pairs)
-                for key, value in data.items():
-                    form.add_field(key, value)
-
-                # Send the POST request
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(url, headers=headers, data=form) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        else:
-                            print(f"Request failed with status code {response.status}")
-                            return None
-            elif method == 'PUT':
-                async with session.put(url, headers=headers, data=data, json=json) as response:
-                    if response:
-                        return await response.json()
-            elif method == 'DELETE':
-                async with session.delete(url, headers=headers) as response:
+class UploadProgress:
+    """Tracks how many bytes of a streamed upload have been sent."""
+
+    def __init__(self, total_bytes: Optional[int] = None, on_progress: Optional[Callable[[int, Optional[int]], Any]] = None):
+        self.total_bytes = total_bytes
+        self.bytes_sent = 0
+        self.on_progress = on_progress
+
+    def update(self, chunk_size: int):
+        self.bytes_sent += chunk_size
+        if self.on_progress:
+            self.on_progress(self.bytes_sent, self.total_bytes)
+
+
+async def _get_upload_size(source) -> Optional[int]:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    if isinstance(source, (str, os.PathLike)):
+        return await asyncio.to_thread(os.path.getsize, source)
+    content_length = getattr(source, "content_length", None)
+    if content_length:
+        return content_length
+    stream = getattr(source, "stream", source)
+    try:
+        position = stream.tell()
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+        return size - position
+    except Exception:
+        return None
+
+
+def _get_upload_filename(source) -> str:
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.basename(source)
+    filename = getattr(source, "filename", None) or getattr(source, "name", None)
+    if isinstance(filename, str) and filename:
+        return os.path.basename(filename)
+    return "file"
+
+
+def _get_upload_content_type(source, filename) -> str:
+    content_type = getattr(source, "mimetype", None) or getattr(source, "content_type", None)
+    if content_type:
+        return content_type
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+async def iter_file_chunks(source, chunk_size: int = UPLOAD_CHUNK_SIZE, progress: Optional[UploadProgress] = None):
+    """
+    Yield the content of `source` in chunks of at most `chunk_size` bytes.
+
+    `source` can be a file path, raw bytes, a sync file-like object (e.g. a Quart
+    FileStorage) or an async file-like object (e.g. an aiofiles handle).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for offset in range(0, len(view), chunk_size):
+            chunk = bytes(view[offset:offset + chunk_size])
+            if progress:
+                progress.update(len(chunk))
+            yield chunk
+        return
+
+    if isinstance(source, (str, os.PathLike)):
+        async with aiofiles.open(source, 'rb') as f:
+            while chunk := await f.read(chunk_size):
+                if progress:
+                    progress.update(len(chunk))
+                yield chunk
+        return
+
+    stream = getattr(source, "stream", source)
+    if hasattr(stream, "seek"):
+        stream.seek(0)
+    is_async = inspect.iscoroutinefunction(stream.read)
+    while True:
+        chunk = await stream.read(chunk_size) if is_async else await asyncio.to_thread(stream.read, chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if progress:
+            progress.update(len(chunk))
+        yield chunk
+
+
+async def _build_multipart_body(files, data, on_progress=None):
+    filename = _get_upload_filename(files)
+    progress = UploadProgress(total_bytes=await _get_upload_size(files), on_progress=on_progress)
+
+    writer = aiohttp.MultipartWriter('form-data')
+    file_payload = aiohttp.payload.AsyncIterablePayload(iter_file_chunks(files, progress=progress),
+                                                        content_type=_get_upload_content_type(files, filename))
+    file_payload.set_content_disposition('form-data', name='file', filename=filename)
+    writer.append_payload(file_payload)
+
+    # Add additional form data (key-value pairs)
+    for key, value in (data or {}).items():
+        part = writer.append(str(value))
+        part.set_content_disposition('form-data', name=key)
+    return writer, progress
+
+
+async def send_request(headers, url, method, data, json, files=None, on_progress=None, params=None):
+    session = await get_http_session()
+    try:
+        if method == 'GET':
+            async with session.get(url, headers=headers, params=params) as response:
+                if response and (response.status == 200 or response.status == 404):
+                    return await response.json()
+        elif method == 'POST':
+            if not files:
+                async with session.post(url, headers=headers, data=data, json=json) as response:
                     if response:
-                        return await response.json()
+                        data = await response.json()
+                        return data
+            body, progress = await _build_multipart_body(files=files, data=data, on_progress=on_progress)
+
+            # Send the POST request, the file is streamed while the request body is written
+            async with session.post(url, headers=headers, data=body) as response:
+                logger.info(f"Uploaded {progress.bytes_sent} bytes to {url}")
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    print(f"Request failed with status code {response.status}")
+                    return None
+        elif method == 'PUT':
+            async with session.put(url, headers=headers, data=data, json=json) as response:
+                if response:
+                    return await response.json()
+        elif method == 'PATCH':
+            async with session.patch(url, headers=headers, data=data, json=json) as response:
+                response.raise_for_status()
+                return await response.json()
+        elif method == 'DELETE':
+            async with session.delete(url, headers=headers) as response:
+                if response:
+                    return await response.json()
 
-        except Exception as e:
-            logger.exception(e)
-            raise
+    except Exception as e:
+        logger.exception(e)
+        raise
 
 
-async def send_post_request(token: str, api_url: str, path: str, data=None, json=None, user_file=None) -> Optional[Any]:
+async def send_post_request(token: str, api_url: str, path: str, data=None, json=None, user_file=None,
+                            on_progress=None) -> Optional[Any]:
     url = f"{api_url}/{path}" if path else f"{api_url}"
     token = f"Bearer {token}" if not token.startswith('Bearer') else token
     try:
@@ -514,7 +619,8 @@ async def send_post_request(token: str, api_url: str, path: str, data=None, json
             "Authorization": f"{token}",
         }
         # Remove Content-Type from headers as it will be set automatically in multipart
-        response = await send_request(headers=headers, url=url, method='POST', data=data, json=json, files=user_file)
+        response = await send_request(headers=headers, url=url, method='POST', data=data, json=json, files=user_file,
+                                      on_progress=on_progress)
         return response
     except Exception as err:
         logger.error(f"Error during POST request to {url}: {err}")
@@ -537,6 +643,22 @@ async def send_put_request(token: str, api_url: str, path: str, data=None, json=
         raise
 
 
+async def send_patch_request(token: str, api_url: str, path: str, data=None, json=None) -> Optional[Any]:
+    url = f"{api_url}/{path}" if path else f"{api_url}"
+    token = f"Bearer {token}" if not token.startswith('Bearer') else token
+    headers = {
+        "Content-Type": "application/json-patch+json",
+        "Authorization": f"{token}",
+    }
+    try:
+        response = await send_request(headers, url, 'PATCH', data, json)
+        logger.info(f"PATCH request to {url} successful.")
+        return response
+    except Exception as err:
+        logger.error(f"Error during PATCH request to {url}: {err}")
+        raise
+
+
 async def send_delete_request(token: str, api_url: str, path: str) -> Optional[Any]:
     url = f"{api_url}/{path}" if path else f"{api_url}"
     token = f"Bearer {token}" if not token.startswith('Bearer') else token
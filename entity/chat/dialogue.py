@@ -0,0 +1,93 @@
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional, Tuple
+
+# Materialized dialogue view kept in chat_flow: the positions of the dialogue entries in
+# finished_flow, their sequence numbers and how many finished_flow entries it covers.
+# Sequence numbers only ever grow, entries added after a rollback never reuse the
+# number of an entry the rollback removed.
+DIALOGUE_VIEW = "dialogue_view"
+
+
+def is_dialogue_entry(item) -> bool:
+    """Whether a finished flow entry is shown to the user: published questions and notifications, and answers."""
+    return bool(((item.get("question") or item.get("notification")) and item.get("publish")) or item.get("answer"))
+
+
+def append_to_flow(chat, entry):
+    """Append `entry` to the chat's finished flow and to the dialogue view."""
+    finished_flow = chat["chat_flow"].setdefault("finished_flow", [])
+    view = _dialogue_view(chat)
+    if is_dialogue_entry(entry):
+        _add(view, len(finished_flow))
+    finished_flow.append(entry)
+    view["length"] = len(finished_flow)
+
+
+def truncate_flow(chat, length: int):
+    """Drop the finished flow entries from position `length` on, and the dialogue view with them."""
+    finished_flow = chat["chat_flow"].setdefault("finished_flow", [])
+    view = _dialogue_view(chat)
+    del finished_flow[length:]
+    cut = bisect_left(view["positions"], length)
+    del view["positions"][cut:]
+    del view["seqs"][cut:]
+    view["length"] = len(finished_flow)
+
+
+def _dialogue_view(chat) -> Dict[str, Any]:
+    """
+    The chat's dialogue view. It is built on first use for chats that don't have one
+    (or one without sequence numbers), rebuilt with new sequence numbers if the flow was
+    cut without `truncate_flow` and catches up with entries appended without
+    `append_to_flow`.
+    """
+    chat_flow = chat.setdefault("chat_flow", {})
+    finished_flow = chat_flow.setdefault("finished_flow", [])
+    view = chat_flow.get(DIALOGUE_VIEW)
+    if view is None or "seqs" not in view or view["length"] > len(finished_flow):
+        next_seq = view.get("next_seq", 1) if view else 1
+        view = chat_flow[DIALOGUE_VIEW] = {"positions": [], "seqs": [], "length": 0, "next_seq": next_seq}
+    for position in range(view["length"], len(finished_flow)):
+        if is_dialogue_entry(finished_flow[position]):
+            _add(view, position)
+    view["length"] = len(finished_flow)
+    return view
+
+
+def _add(view, position):
+    view["positions"].append(position)
+    view["seqs"].append(view["next_seq"])
+    view["next_seq"] += 1
+
+
+def get_dialogue(chat) -> List[Any]:
+    finished_flow = chat["chat_flow"]["finished_flow"] if "chat_flow" in chat else []
+    return [finished_flow[position] for position in _dialogue_view(chat)["positions"]]
+
+
+def get_dialogue_page(chat, limit: int, before: Optional[int] = None,
+                      after: Optional[int] = None) -> Tuple[List[Any], Dict[str, Any]]:
+    """
+    Up to `limit` dialogue entries after the `after` cursor, or else before the `before`
+    cursor (the latest ones by default). A cursor is the sequence number of an entry.
+    """
+    view = _dialogue_view(chat)
+    seqs = view["seqs"]
+    if after is not None:
+        start = bisect_right(seqs, after)
+        end = min(start + limit, len(seqs))
+        has_more = end < len(seqs)
+    else:
+        end = bisect_left(seqs, before) if before is not None else len(seqs)
+        start = max(0, end - limit)
+        has_more = start > 0
+    finished_flow = chat["chat_flow"]["finished_flow"]
+    page = {
+        "limit": limit,
+        # cursors of the first and last entry, `before=first` / `after=last` get the next pages
+        "first": seqs[start] if start < end else None,
+        "last": seqs[end - 1] if start < end else None,
+        # whether there are more entries in the direction of the request
+        "has_more": has_more,
+    }
+    return [finished_flow[position] for position in view["positions"][start:end]], page
@@ -0,0 +1,173 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from common.config.config import QUESTION_STREAM_BUFFER, QUESTION_STREAM_MAX_CHANNELS
+
+
+def _last_seq(questions_queue) -> int:
+    # Chats queued before sequence numbers existed count their questions as 1..n
+    return questions_queue.get("last_seq", len(questions_queue.get("new_questions", [])))
+
+
+def peek_questions(chat) -> Tuple[int, List[Tuple[int, Any]]]:
+    """The chat's last sequence number and its undelivered questions as (seq, question), left in the chat."""
+    questions_queue = chat.get("questions_queue") or {}
+    new_questions = questions_queue.get("new_questions") or []
+    last_seq = _last_seq(questions_queue)
+    return last_seq, list(enumerate(new_questions, last_seq - len(new_questions) + 1))
+
+
+def take_questions(chat, up_to_seq: Optional[int] = None) -> List[Tuple[int, Any]]:
+    """
+    Remove the undelivered questions queued in the chat (up to `up_to_seq` if given)
+    and return them as (seq, question).
+    """
+    last_seq, queued = peek_questions(chat)
+    taken = [(seq, question) for seq, question in queued if up_to_seq is None or seq <= up_to_seq]
+    questions_queue = chat.setdefault("questions_queue", {})
+    del questions_queue.setdefault("new_questions", [])[:len(taken)]
+    questions_queue["last_seq"] = last_seq
+    return taken
+
+
+class _Channel:
+    __slots__ = ("buffer", "held", "subscriptions")
+
+    def __init__(self, buffer_size):
+        self.buffer: Deque[Tuple[int, Any]] = deque(maxlen=buffer_size)
+        # Published, pushed once the chat is stored
+        self.held: List[Tuple[int, Any]] = []
+        self.subscriptions: Set["QuestionSubscription"] = set()
+
+
+class QuestionBroker:
+    """
+    Pushes the questions the workflow publishes for a chat to the connections streaming
+    that chat.
+
+    Every question gets the chat's next sequence number (kept in the chat as
+    `questions_queue.last_seq`) and is still queued in `questions_queue.new_questions`
+    until a stream or a poll has delivered it. Published questions are held back until
+    `release()` is called once the chat that queues them is stored, so nothing is pushed
+    that a reader of the stored chat can't see. The last `buffer_size` released questions
+    of a chat are kept here, so a client that reconnects with the last sequence number
+    it saw gets what it missed. Only the `max_channels` most recently used chats without
+    listeners keep their buffer.
+    """
+
+    def __init__(self, buffer_size: int = QUESTION_STREAM_BUFFER, max_channels: int = QUESTION_STREAM_MAX_CHANNELS):
+        self.buffer_size = buffer_size
+        self.max_channels = max_channels
+        self._channels: OrderedDict[str, _Channel] = OrderedDict()
+        self.published = 0
+        self.released = 0
+        self.evicted = 0
+
+    def publish_question(self, technical_id: str, chat: Any, question: Any) -> int:
+        """Queue `question` in the chat until the chat is stored, returns its sequence number."""
+        questions_queue = chat.setdefault("questions_queue", {})
+        new_questions = questions_queue.setdefault("new_questions", [])
+        seq = _last_seq(questions_queue) + 1
+        new_questions.append(question)
+        questions_queue["last_seq"] = seq
+        self._channel(technical_id).held.append((seq, question))
+        self.published += 1
+        return seq
+
+    def release(self, technical_id: str):
+        """Push the questions published for the chat to its streams, call it once the chat is stored."""
+        channel = self._channels.get(technical_id)
+        if channel is None or not channel.held:
+            return
+        held, channel.held = channel.held, []
+        for seq, question in held:
+            channel.buffer.append((seq, question))
+            for subscription in list(channel.subscriptions):
+                subscription.deliver(technical_id, seq, question)
+        self.released += len(held)
+
+    def subscribe(self) -> "QuestionSubscription":
+        return QuestionSubscription(self)
+
+    def _channel(self, technical_id) -> _Channel:
+        channel = self._channels.get(technical_id)
+        if channel is None:
+            channel = self._channels[technical_id] = _Channel(self.buffer_size)
+            self._evict()
+        self._channels.move_to_end(technical_id)
+        return channel
+
+    def _evict(self):
+        for technical_id in list(self._channels):
+            if len(self._channels) <= self.max_channels:
+                break
+            if not self._channels[technical_id].subscriptions:
+                del self._channels[technical_id]
+                self.evicted += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "channels": len(self._channels),
+            "subscriptions": sum(len(channel.subscriptions) for channel in self._channels.values()),
+            "published": self.published,
+            "released": self.released,
+            "evicted": self.evicted,
+        }
+
+
+class QuestionSubscription:
+    """The questions of all chats one connection streams, in a single queue and in order per chat."""
+
+    def __init__(self, broker: QuestionBroker):
+        self._broker = broker
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._last_seqs: Dict[str, int] = {}
+
+    @property
+    def chats(self) -> List[str]:
+        return list(self._last_seqs)
+
+    def add(self, technical_id: str, last_seq: int, pending: Iterable[Tuple[int, Any]] = ()):
+        """
+        Start streaming the chat after `last_seq`. `pending` are the (seq, question) taken
+        from the chat's queue, they go before the buffered ones.
+        """
+        self._last_seqs[technical_id] = max(last_seq, self._last_seqs.get(technical_id, 0))
+        for seq, question in pending:
+            self.deliver(technical_id, seq, question)
+        channel = self._broker._channel(technical_id)
+        channel.subscriptions.add(self)
+        for seq, question in channel.buffer:
+            self.deliver(technical_id, seq, question)
+
+    def remove(self, technical_id: str):
+        self._last_seqs.pop(technical_id, None)
+        channel = self._broker._channels.get(technical_id)
+        if channel is not None:
+            channel.subscriptions.discard(self)
+
+    def deliver(self, technical_id: str, seq: int, question: Any):
+        last_seq = self._last_seqs.get(technical_id)
+        if last_seq is None or seq <= last_seq:
+            return
+        self._last_seqs[technical_id] = seq
+        self._queue.put_nowait((technical_id, seq, question))
+
+    async def get(self, timeout: float) -> Optional[Tuple[str, int, Any]]:
+        """Wait up to `timeout` seconds for the next (technical_id, seq, question)."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def get_ready(self) -> List[Tuple[str, int, Any]]:
+        """All (technical_id, seq, question) that are already waiting."""
+        events = []
+        while not self._queue.empty():
+            events.append(self._queue.get_nowait())
+        return events
+
+    def close(self):
+        for technical_id in self.chats:
+            self.remove(technical_id)
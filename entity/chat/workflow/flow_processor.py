@@ -1,7 +1,10 @@
+import asyncio
 import json
 import logging
 from openai.types.chat.chat_completion import ChatCompletionMessage
 
+from common.config.config import ENTITY_VERSION
+from common.util.keyed_lock import KeyedLock
 from common.util.utils import _save_file
 
 # Setup logging
@@ -9,11 +12,55 @@ logger = logging.getLogger(__name__)
 
 
 class FlowProcessor:
-    def __init__(self, workflow_dispatcher, mock=False):
+    def __init__(self, workflow_dispatcher, mock=False, chat_locks: KeyedLock = None, entity_service=None,
+                 entity_pins=None):
         self.workflow_dispatcher = workflow_dispatcher
         self.mock = mock
+        # Held only while the chat is stored, the requests that modify the chat hold it
+        # for their read-modify-write
+        self.chat_locks = chat_locks or KeyedLock()
+        # Workflow runs of the same chat are serialized, AI calls included
+        self._run_locks = KeyedLock()
+        # Chats with a workflow run scheduled or in progress
+        self._running = {}
+        # If set, the chat is stored after every run
+        self.entity_service = entity_service
+        # If set (a repository with pin/unpin), the chat stays live in its memory while a run modifies it
+        self.entity_pins = entity_pins
+
+    def run_workflow(self, fsm, entity, technical_id, current_state=None) -> asyncio.Task:
+        """Run the workflow of the chat in the background, the chat counts as running right away."""
+        return self._start(technical_id, entity, self._run_workflow(fsm=fsm, entity=entity, technical_id=technical_id,
+                                                                    current_state=current_state))
+
+    def trigger_manual_transition(self, current_state, event, entity, fsm, technical_id) -> asyncio.Task:
+        """Trigger a manual transition in the background, the chat counts as running right away."""
+        return self._start(technical_id, entity,
+                           self._trigger_manual_transition(current_state=current_state, event=event, entity=entity,
+                                                           fsm=fsm, technical_id=technical_id))
+
+    def is_running(self, technical_id) -> bool:
+        return technical_id in self._running
+
+    def _start(self, technical_id, entity, run) -> asyncio.Task:
+        self._running[technical_id] = self._running.get(technical_id, 0) + 1
+        if self.entity_pins is not None:
+            # Pinned right away, the object the run modifies is the one that stays live
+            self.entity_pins.pin(technical_id, entity)
+        return asyncio.create_task(self._run_serialized(technical_id, run))
+
+    async def _run_serialized(self, technical_id, run):
+        try:
+            async with self._run_locks.lock(technical_id):
+                return await run
+        finally:
+            if self.entity_pins is not None:
+                self.entity_pins.unpin(technical_id)
+            self._running[technical_id] -= 1
+            if not self._running[technical_id]:
+                del self._running[technical_id]
 
-    async def run_workflow(self, fsm, entity, technical_id, current_state=None):
+    async def _run_workflow(self, fsm, entity, technical_id, current_state=None):
         if current_state is None:
             current_state = fsm["initial_state"]
         while True:
@@ -60,9 +107,22 @@ class FlowProcessor:
         entity["current_state"]=current_state
         entity["transition"] = event
         await _save_file(chat_id=technical_id, _data=json.dumps(entity, cls=ChatCompletionMessageEncoder), item="entity/chat.json")
+        await self._store_entity(entity=entity, technical_id=technical_id)
         return current_state
 
-    async def trigger_manual_transition(self, current_state, event, entity, fsm, technical_id):
+    async def _store_entity(self, entity, technical_id):
+        if self.entity_service is not None:
+            async with self.chat_locks.lock(technical_id):
+                await self.entity_service.update_item(token=None,
+                                                      entity_model="chat",
+                                                      entity_version=ENTITY_VERSION,
+                                                      technical_id=technical_id,
+                                                      entity=entity,
+                                                      meta={})
+        # The questions the run published are in the stored chat now
+        self.workflow_dispatcher.question_broker.release(technical_id)
+
+    async def _trigger_manual_transition(self, current_state, event, entity, fsm, technical_id):
         """
         Triggers a manual transition from the current state for a given event.
 
@@ -114,13 +174,14 @@ class FlowProcessor:
             logger.info(f"Manual-triggered transition: from '{current_state}' to '{next_state}' via event '{event}'.")
             entity["current_state"] = next_state
         finally:
-            current_state = await self.run_workflow(fsm=fsm,
-                                                    entity=entity,
-                                                    technical_id=technical_id,
-                                                    current_state=entity["current_state"])
+            current_state = await self._run_workflow(fsm=fsm,
+                                                     entity=entity,
+                                                     technical_id=technical_id,
+                                                     current_state=entity["current_state"])
             entity["current_state"] = current_state
             entity["transition"] = event
             await _save_file(chat_id=technical_id, _data=json.dumps(entity, cls=ChatCompletionMessageEncoder), item="entity/chat.json")
+            await self._store_entity(entity=entity, technical_id=technical_id)
             return current_state
 
 class ChatCompletionMessageEncoder(json.JSONEncoder):
@@ -2,17 +2,20 @@ import inspect
 import logging
 from common.config.conts import OPEN_AI
 from common.util.utils import _save_file
+from entity.chat.dialogue import append_to_flow
+from entity.chat.question_broker import QuestionBroker
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 class WorkflowDispatcher:
-    def __init__(self, cls, cls_instance, ai_agent, mock=False):
+    def __init__(self, cls, cls_instance, ai_agent, mock=False, question_broker: QuestionBroker = None):
         self.cls = cls
         self.cls_instance = cls_instance
         self.methods_dict = self.collect_subclass_methods()
         self.ai_agent = ai_agent
+        self.question_broker = question_broker or QuestionBroker()
 
     def collect_subclass_methods(self):
 
@@ -72,15 +75,12 @@ class WorkflowDispatcher:
 
     async def _handle_config_based_event(self, config, entity, technical_id):
         response = None
-        finished_stack = entity["chat_flow"].get("finished_flow", [])
+        finished_stack = entity["chat_flow"].setdefault("finished_flow", [])
         config_type = config.get("type")
 
         if config_type in ("notification", "question"):
-            questions_queue = entity.setdefault("questions_queue", {})
-            new_questions = questions_queue.setdefault("new_questions", [])
-
             if config.get("publish"):
-                new_questions.append(config)
+                self.question_broker.publish_question(technical_id, entity, config)
 
         elif config_type == "function":
             params = config["function"].get("parameters", {})
@@ -151,7 +151,7 @@ class WorkflowDispatcher:
 
     async def finalize_response(self, technical_id, entity, config, finished_stack, response):
 
-        finished_stack.append(config)
+        append_to_flow(entity, config)
 
         if config["type"] in ("function", "prompt", "agent"):
 
@@ -163,9 +163,9 @@ class WorkflowDispatcher:
                     "approve": config.get("approve", False),
                     "type": "notification"
                 }
-                finished_stack.append(notification)
+                append_to_flow(entity, notification)
                 if config.get("publish"):
-                    entity["questions_queue"]["new_questions"].append(notification)
+                    self.question_broker.publish_question(technical_id, entity, notification)
 
             await self.write_to_output(config=config,
                                        response=response,
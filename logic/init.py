@@ -1,12 +1,17 @@
-import asyncio
 import os
 
 from common.ai.ai_agent import OpenAiAgent
 from common.ai.clients.openai_client import AsyncOpenAIClient
-from common.config.config import CHAT_REPOSITORY
+from common.auth.auth import validate_remote_token
+from common.auth.jwt_verifier import JwtVerifier
+from common.auth.token_cache import TokenValidationCache
+from common.config.config import CHAT_REPOSITORY, INMEMORY_PERSISTENCE_DIR
 from common.repository.cyoda.cyoda_repository import CyodaRepository
 from common.repository.in_memory_db import InMemoryRepository
+from common.repository.sqlite_repository import SqliteRepository
 from common.service.service import EntityServiceImpl
+from common.util.keyed_lock import KeyedLock
+from entity.chat.question_broker import QuestionBroker
 from entity.chat.workflow.flow_processor import FlowProcessor
 from entity.chat.workflow.workflow import ChatWorkflow
 from entity.workflow import Workflow
@@ -20,14 +25,18 @@ class BeanFactory:
         or rely on environment variables/default values.
         """
         # Load configuration, allowing overrides via environment or parameter.
-        # Initialize asynchronous lock (e.g., for handling concurrent chat operations)
-        self.chat_lock = asyncio.Lock()
+        # One lock per chat (technical_id) for operations that must not run concurrently on the same chat
+        self.chat_locks = KeyedLock()
+        # Pushes the questions the workflow publishes to the clients streaming the chat
+        self.question_broker = QuestionBroker()
 
         try:
             # Create the repository based on configuration.
             self.dataset = {}
             self.device_sessions = {}
             self.workflow = Workflow()
+            self.token_validation_cache = TokenValidationCache(validator=validate_remote_token)
+            self.jwt_verifier = JwtVerifier()
             self.entity_repository = self._create_repository(CHAT_REPOSITORY)
             self.entity_service = EntityServiceImpl(repository=self.entity_repository)
 
@@ -41,9 +50,18 @@ class BeanFactory:
                 cls=ChatWorkflow,
                 cls_instance=self.chat_workflow,
                 ai_agent=self.ai_agent,
+                question_broker=self.question_broker,
             )
+            in_memory = isinstance(self.entity_repository, InMemoryRepository)
             self.flow_processor = FlowProcessor(
-                workflow_dispatcher=self.workflow_dispatcher
+                workflow_dispatcher=self.workflow_dispatcher,
+                chat_locks=self.chat_locks,
+                # Other worker processes only see the chat once it is stored, a persistent
+                # in-memory repository only logs it then
+                entity_service=self.entity_service
+                if CHAT_REPOSITORY == "sqlite" or (in_memory and INMEMORY_PERSISTENCE_DIR) else None,
+                # The local repository serves the chat a run modifies in place
+                entity_pins=self.entity_repository if in_memory else None
             )
 
 
@@ -67,8 +85,15 @@ class BeanFactory:
         """
         if repo_type.lower() == "cyoda":
             return CyodaRepository()
+        elif repo_type.lower() == "sqlite":
+            repository = SqliteRepository()
+            repository.declare_index("chat", "$.user_id")
+            return repository
         else:
-            return InMemoryRepository()
+            repository = InMemoryRepository()
+            # Chats are listed by owner
+            repository.declare_index("chat", "$.user_id")
+            return repository
 
     def get_flow_processor(self):
         """
@@ -81,7 +106,10 @@ class BeanFactory:
         Retrieve a dictionary of all managed services for further use.
         """
         return {
-            "chat_lock": self.chat_lock,
+            "chat_locks": self.chat_locks,
+            "question_broker": self.question_broker,
+            "token_validation_cache": self.token_validation_cache,
+            "jwt_verifier": self.jwt_verifier,
             "entity_repository": self.entity_repository,
             "entity_service": self.entity_service,
             "ai_agent": self.ai_agent,